@@ -1,6 +1,8 @@
 # first written by nandflash("저장장치") <github@printk.info> since 2020-06-25
 
 import socket
+import select
+import asyncio
 import serial
 import paho.mqtt.client as paho_mqtt
 import json
@@ -8,13 +10,32 @@ import json
 import sys
 import time
 import logging
-from logging.handlers import TimedRotatingFileHandler
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, QueueListener
+import queue
+import atexit
+import signal
 import os.path
 import re
+import math
+import random
+import bisect
 
 import os
 import urllib.request
 import subprocess
+import array
+import collections
+import struct
+import threading
+import http.server
+import copy
+import importlib.util
+
+try:
+    import fcntl
+    import termios
+except ImportError:
+    fcntl = None
 
 ####################
 VIRTUAL_DEVICE = {
@@ -107,11 +128,12 @@ VIRTUAL_DEVICE = {
 RS485_DEVICE = {
     # 전등 스위치
     "light": {
-        "query":    { "header": 0xAC79, "length":  5, "id": 2, },
+        # query의 Byte[2]는 항상 00, 방 번호(RN) 대신 그룹 번호(GR)만 있음 -> id2
+        "query":    { "header": 0xAC79, "length":  5, "id2": 3, },
         "state":    { "header": 0xB079, "length":  5, "id": 2, "parse": {("power", 3, "bitmap")} },
         "last":     { },
 
-        "power":    { "header": 0xAC7A, "length":  5, "id": 2, "pos": 3, },
+        "power":    { "header": 0xAC7A, "length":  5, "id": 2, "pos": 3, "prio": 1, },
     },
 
     # 환기장치 (전열교환기)
@@ -120,8 +142,8 @@ RS485_DEVICE = {
         "state":    { "header": 0xB04E, "length":  6, "parse": {("power", 4, "fan_toggle"), ("preset", 2, "fan_speed")} },
         "last":     { },
 
-        "power":    { "header": 0xC24F, "length":  6, "pos": 2, },
-        "preset":   { "header": 0xC24F, "length":  6, "pos": 2, },
+        "power":    { "header": 0xC24F, "length":  6, "pos": 2, "prio": 3, },
+        "preset":   { "header": 0xC24F, "length":  6, "pos": 2, "prio": 3, },
     },
 
     # 각방 난방 제어
@@ -150,7 +172,7 @@ RS485_DEVICE = {
         "state":    { "header": 0xB052, "length":  4, "parse": {("power", 2, "toggle")} }, # 1: 정상, 0: 일괄소등
         "last":     { },
 
-        "power":    { "header": 0xAD53, "length":  4, "pos": 2, },
+        "power":    { "header": 0xAD53, "length":  4, "pos": 2, "prio": 1, },
     },
 
     # 부엌 가스 밸브
@@ -161,7 +183,7 @@ RS485_DEVICE = {
         "state":    { "header": 0xAB41, "length":  8, "parse": {("power", 6, "invert")} }, # 0: 정상, 1: 차단; 0xB041은 공용 ack이므로 query에서부터 읽어서 처리
         "last":     { },
 
-        "power":    { "header": 0xAB78, "length":  4, }, # 0 으로 잠그기만 가능
+        "power":    { "header": 0xAB78, "length":  4, "prio": 0, }, # 0 으로 잠그기만 가능
     },
 
     # 실시간에너지 0:전기, 1:가스, 2:수도
@@ -370,12 +392,50 @@ QUERY_HEADER = {
     if "query" in prop
 }
 
+# query와 state header가 다른 장치만 응답했는지 확인할 수 있음 (가스밸브는 query부터 state로 읽음)
+TRANSACTION_DEVICE = {
+    device
+    for device, prop in RS485_DEVICE.items()
+    if "query" in prop and prop["query"]["header"] != prop["state"]["header"]
+}
+
 HEADER_0_STATE = 0xB0
 HEADER_0_FIRST = 0xA1
 header_0_virtual = {}
 HEADER_1_SCAN = 0x5A
+
+# serial_process에서 header로 할 일을 한번에 찾기 위한 table (16bit header로 바로 접근)
+# header -> (flags, STATE_HEADER/QUERY_HEADER 값, header 뒤로 더 읽어야 하는 Byte 수)
+# 가상 장치 ack 대기나 HEADER_0_FIRST가 바뀔 때 해당 header만 다시 만든다
+DISPATCH_ACK = 0x01
+DISPATCH_AVAIL = 0x02
+DISPATCH_VIRTUAL = 0x04
+DISPATCH_STATE = 0x08
+DISPATCH_RESP = 0x10
+DISPATCH_QUERY = 0x20
+DISPATCH_SCAN = 0x40
+DISPATCH_FIRST = 0x80
+serial_dispatch = []
+
+# 가상 장치 응답 전, 나머지 byte 기다릴 때 전송 시간에 더해줄 여유 (EW11은 자체적으로 모아서 보내므로 넉넉히)
+VIRTUAL_WAIT_MARGIN = 0.02
 header_0_first_candidate = [ 0xAB, 0xAC, 0xAD, 0xAE, 0xC2, 0xA5 ]
 
+# polling 주기 시작 찾기: HEADER_0_FIRST가 안 보이면, 처음 받은 header 순서의 자기상관으로 주기 길이를 구하고
+# 주기마다 한번씩만 나오는 header_0 중 바로 앞이 가장 오래 조용했던 것을 시작으로 본다 (못 찾으면 위 후보를 6초씩 시도)
+# 자기상관은 header가 들어올 때마다 조금씩 셈: cycle_match[p]는 p만큼 앞의 header와 같았던 횟수
+# (cycle_positions: header -> 나왔던 위치 목록, 같은 header끼리만 비교하므로 header 하나에 몇 번만 셈)
+cycle_headers = []
+cycle_positions = {}
+cycle_match = []
+cycle_detecting = False
+cycle_length = 0
+CYCLE_DETECT_MIN = 32
+CYCLE_DETECT_MAX = 384
+CYCLE_DETECT_STEP = 16
+CYCLE_MATCH_RATIO = 0.8
+CYCLE_GAP_MIN = 0.005
+
 
 # human error를 로그로 찍기 위해서 그냥 전부 구독하자
 #SUB_LIST = { "{}/{}/+/+/command".format(Options["mqtt"]["prefix"], device) for device in RS485_DEVICE } |\
@@ -386,12 +446,131 @@ virtual_trigger = {}
 virtual_ack = {}
 virtual_avail = []
 
-serial_queue = {}
+# 만료된 가상 장치 트리거: timer 스레드는 넣기만 하고, virtual_trigger 등을 쓰는 serial 처리 쪽에서 지움 (경합 방지)
+virtual_expired = collections.deque()
+
+serial_queue = None
 serial_ack = {}
 
-last_query = int(0).to_bytes(2, "big")
+# 재시도 만료된 명령: timer 스레드는 넣기만 하고, serial_ack를 쓰는 serial 처리 쪽에서 정리 (경합 방지)
+serial_expired = collections.deque()
+
+# 재시도 만료, 재시도 간격, 가상 장치 트리거 만료를 버스 상황과 상관없이 처리하는 timer (monotonic)
+timer_wheel = None
+timer_worker = None
+TIMER_TICK = 0.05
+
+# 응답 없이 이 시간이 지나면 경고하고, 재시도 간격을 점점 늘림 (월패드 polling과 덜 부딪히도록)
+RETRY_BACKOFF_AFTER = 3
+RETRY_BACKOFF_MIN = 0.1
+RETRY_BACKOFF_MAX = 1.0
+
+publish_queue = None
+publish_worker = None
+
+# 명령 우선순위 (작을수록 먼저), RS485_DEVICE에 "prio"가 없는 명령에 적용
+COMMAND_PRIORITY_DEFAULT = 2
+
 last_topic_list = {}
 
+# query/응답 짝 맞추기: 응답 오기 전에 다음 query가 나오면 무응답(miss)
+# 응답 대기 중인 query: (device, idn (모르면 None), query 전송이 끝난 시각, query packet)
+# (device, idn) -> [응답 수, 무응답 수, 연속 무응답 수, online 여부]
+transaction_pending = None
+transaction_stat = {}
+
+# query에 id가 없는 장치 (조명): (device, id2) -> 그 query에 응답했던 id, 무응답을 어느 장치로 셀지 정할 때 사용
+transaction_room = {}
+
+# 발견한 장치 목록: device -> {idn: 조명 id2 (다른 장치는 None)}, warm start cache에 저장
+discovered_devices = {}
+
+# 아직 등록 안 한 장치를 본 횟수: (device, idn) -> [횟수, 조명 id2]
+discovery_seen = {}
+
+# warm start: 이전 실행의 장치 목록, 마지막 패킷, 마지막 publish 값을 파일로 저장해뒀다가 시작할 때 읽음
+CACHE_VERSION = 1
+cache_pending = None
+cache_saved = None
+cache_lock = threading.Lock()
+cache_event = threading.Event()
+warm_start = False
+
+# 자주 바뀌는 값의 publish 제한 (publish_policy): "device/attr" 또는 "device" -> (deadband, relative, min_interval, heartbeat)
+PUBLISH_POLICY = {}
+last_publish_time = {}
+
+# heartbeat가 있는 장치: (device, idn) -> 가장 먼저 다시 publish 해야 하는 시각, 같은 패킷이 와도 이 때는 다시 확인
+heartbeat_due = {}
+
+# RS485_DEVICE로부터 미리 만들어 둔 codec (init_codec)
+# 상태 decoder: device별 (attr, pos, table) 목록, table은 Byte 값별 publish 값 (여러 Byte 쓰는 형식은 함수)
+# 명령 encoder: (device, 명령)별 (packet 틀, id 위치, 값 위치, 틀의 checksum)
+STATE_DECODER = {}
+COMMAND_ENCODER = {}
+state_topics = {}
+
+# 월패드 polling 주기 학습: 패킷(slot)마다 다음 header가 나오기까지 비어있는 시간의 평균, 분산
+# 같은 header가 한 주기에 여러번 나오므로 (방마다 AE7C, B079 등) slot은 (주기 시작부터 몇 번째 패킷 << 16) | header
+# 주기 시작(HEADER_0_FIRST)을 보기 전에는 순서를 모르므로 학습하지 않음 (bus_schedule_pos = None)
+bus_schedule = {}
+bus_schedule_last = None
+bus_schedule_pos = None
+SCHEDULE_ALPHA = 0.1
+SCHEDULE_WARMUP = 10
+SCHEDULE_GUARD = 0.003
+SCHEDULE_QUIET_RATIO = 0.5
+SCHEDULE_PUBLISH_LOOPS = 30
+SCHEDULE_BACKLOG = 10
+
+# 명령 지연시간 통계: (구간, device, 명령)별 히스토그램
+# queue: HA 명령 수신 ~ 첫 전송, ack: 첫 전송 ~ 장치 ack, virtual: 가상 장치 트리거 ~ 월패드 ack
+latency_stat = {}
+latency_report_time = 0
+LATENCY_REPORT_INTERVAL = 600
+virtual_sends = {}
+
+# 설치 환경 확인용 카운터, metrics endpoint로 노출
+metrics = {
+    "publish": 0,
+    "suppress": 0,
+    "hold": 0,
+    "retry_exceeded_device": 0,
+    "retry_exceeded_virtual": 0,
+    "reconnect": 0,
+    "reconnect_seconds": 0.0,
+    "reconnect_seconds_total": 0.0,
+}
+metrics_frames = {}
+
+# 연결이 끊기면 애드온을 재시작하지 않고 다시 연결 (MQTT 연결, 장치 상태, 명령 대기열 유지)
+# 지수 backoff + jitter로 재시도하고, 너무 오래 안되면 예전처럼 애드온 재시작
+RECONNECT_DELAY_MIN = 0.5
+RECONNECT_DELAY_MAX = 30
+RECONNECT_GIVE_UP = 600
+reconnect_lost_time = None
+
+# failover 모드: serial과 socket을 둘 다 열어두고, 받는 쪽이 멈추거나 checksum 오류가 많으면 다른 쪽으로 전환
+FAILOVER_WINDOW = 1.0
+FAILOVER_MIN_FRAMES = 20
+failover = None
+
+# 여러 RS485 선을 한 프로세스에서 처리할 때, bus 이름별 module (이 파일을 bus마다 따로 읽은 것)
+buses = {}
+
+# capture 파일 형식: header (magic, 시작 시각) 후 record (이전 record와의 간격 us, 방향|길이) + data 반복
+CAPTURE_MAGIC = b"SDSCAP\x01\x00"
+CAPTURE_HEADER = struct.Struct("<8sd")
+CAPTURE_RECORD = struct.Struct("<IH")
+CAPTURE_TX = 0x8000
+
+loop_count = 0
+scan_count = 0
+send_aggressive = False
+framer = None
+recorder = None
+gateway = None
+
 try:
     from paho.mqtt.enums import CallbackAPIVersion
     mqtt = paho_mqtt.Client(CallbackAPIVersion.VERSION1, client_id="sds_wallpad-{}".format(time.time()))
@@ -415,8 +594,6 @@ class SDSSerial:
         self._ser.close()
         self._ser.open()
 
-        self._pending_recv = 0
-
         # 시리얼에 뭐가 떠다니는지 확인
         self.set_timeout(5)
         data = self._recv_raw(1)
@@ -432,22 +609,31 @@ class SDSSerial:
         except Exception as e:
             logger.warning("unhandled exception {}".format(e))
 
-    def recv(self, count=1):
-        # serial은 pending count만 업데이트
-        self._pending_recv = max(self._pending_recv - count, 0)
-        data = self._recv_raw(count)
-        if not data or len(data) < count:
+    def _recv_raw_into(self, view):
+        try:
+            return self._ser.readinto(view)
+        except serial.SerialTimeoutException:
+            return 0
+        except Exception as e:
+            logger.warning("unhandled exception {}".format(e))
+            return 0
+
+    def recv_into(self, view, count=1):
+        # 이미 도착해 있는 만큼 한번에 읽음, 부족하면 count Byte 올 때까지 대기
+        size = min(max(self._ser.in_waiting, count), len(view))
+        n = self._recv_raw_into(view[:size])
+        if not n:
             raise RuntimeError("serial connection lost!")
-        return data
+        return n
 
     def send(self, a):
         self._ser.write(a)
 
-    def set_pending_recv(self):
-        self._pending_recv = self._ser.in_waiting
+    def close(self):
+        self._ser.close()
 
-    def check_pending_recv(self):
-        return self._pending_recv
+    def fileno(self):
+        return self._ser.fileno()
 
     def check_in_waiting(self):
         return self._ser.in_waiting
@@ -464,8 +650,9 @@ class SDSSocket:
         self._soc = socket.socket()
         self._soc.connect((addr, port))
 
-        self._recv_buf = bytearray()
-        self._pending_recv = 0
+        # in_waiting 확인용, 매번 새로 할당하지 않도록 미리 만들어 둠
+        self._nread = array.array("i", [0])
+        self._peek_buf = bytearray(256)
 
         # 소켓에 뭐가 떠다니는지 확인
         self.set_timeout(5)
@@ -482,37 +669,1157 @@ class SDSSocket:
         except Exception as e:
             logger.warning("unhandled exception {}".format(e))
 
-    def recv(self, count=1):
-        # socket은 버퍼와 in_waiting 직접 관리
-        while len(self._recv_buf) < count:
-            new_data = self._recv_raw(256)
-            if not new_data:
-                raise RuntimeError("socket connection lost!")
-            self._recv_buf.extend(new_data)
+    def _recv_raw_into(self, view):
+        try:
+            return self._soc.recv_into(view)
+        except socket.timeout:
+            return 0
+        except Exception as e:
+            logger.warning("unhandled exception {}".format(e))
+            return 0
+
+    def recv_into(self, view, count=1):
+        # socket은 도착한 만큼 바로 돌려주므로 count는 무시해도 된다 (부족하면 framer가 다시 부름)
+        n = self._recv_raw_into(view)
+        if not n:
+            raise RuntimeError("socket connection lost!")
+        return n
+
+    def send(self, a):
+        self._soc.sendall(a)
+
+    def close(self):
+        self._soc.close()
+
+    def fileno(self):
+        return self._soc.fileno()
+
+    def check_in_waiting(self):
+        # 기다리거나 읽지 않고, 소켓에 도착해 있는 양만 확인
+        if fcntl:
+            fcntl.ioctl(self._soc, termios.FIONREAD, self._nread, True)
+            return self._nread[0]
+
+        readable, _, _ = select.select([self._soc], [], [], 0)
+        if not readable:
+            return 0
+        try:
+            return self._soc.recv_into(self._peek_buf, 0, socket.MSG_PEEK)
+        except OSError:
+            return 0
+
+    def set_timeout(self, a):
+        self._soc.settimeout(a)
+
+
+class SDSLink:
+    # failover 모드의 경로 하나 (serial 혹은 socket), 경로별로 카운터를 따로 셈
+    def __init__(self, mode):
+        self.mode = mode
+        self.conn = None
+
+        # standby일 때 받은 데이터를 확인할 framer (active일 때는 메인 framer가 처리)
+        self.framer = SDSFramer(self)
+
+        # metrics용 카운터
+        self.bytes_total = 0
+        self.frames_total = 0
+        self.checksum_fail = 0
+        self.active_total = 0
+        self.last_recv = 0.0
+
+        # 이번 확인 구간의 checksum 성공/실패, 카운터를 가져오는 framer의 마지막 값
+        self.window = [0, 0]
+        self.seen = (0, 0)
+
+    def recv_into(self, view, count=1):
+        n = self.conn.recv_into(view, count)
+        self.bytes_total += n
+        self.last_recv = time.monotonic()
+        return n
+
+    def collect(self, source):
+        # source framer의 checksum 카운터 증가분을 이 경로 몫으로 더함
+        ok = source.frames_total - self.seen[0]
+        fail = source.checksum_fail - self.seen[1]
+        self.seen = (source.frames_total, source.checksum_fail)
+
+        self.frames_total += ok
+        self.checksum_fail += fail
+        self.window[0] += ok
+        self.window[1] += fail
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def check_in_waiting(self):
+        return self.conn.check_in_waiting()
+
+
+class SDSFailover:
+    # 같은 bus에 연결된 serial과 socket을 둘 다 열어두고, 한쪽(active)에서만 패킷을 받고 명령을 보낸다.
+    # 다른 쪽(standby)도 버퍼에 쌓이지 않도록 계속 읽으면서 checksum을 확인해두고,
+    # active가 stall_time 동안 조용한데 standby로는 데이터가 오거나, checksum 성공률이 기준보다 낮으면 바꾼다.
+    def __init__(self):
+        primary = Options["failover"]["primary"]
+        self._stall = Options["failover"]["stall_time"]
+        self._ratio = Options["failover"]["checksum_ratio"]
+        self._timeout = 10
+        self._closed = False
+
+        self.links = [SDSLink(primary), SDSLink("serial" if primary == "socket" else "socket")]
+        self.active = None
+        self.switch_total = 0
+
+        error = None
+        for link in self.links:
+            try:
+                self._open(link)
+            except (RuntimeError, OSError) as e:
+                logger.warning("failover: {} link failed: {}".format(link.mode, e))
+                error = e
+
+        up = [link for link in self.links if link.conn is not None]
+        if not up:
+            raise RuntimeError("failover: no link available! ({})".format(error))
+
+        # 재접속으로 새로 만들어져도 메인 framer 카운터는 이어지므로, 지금 값부터 셈
+        self.active = up[0]
+        self.active.active_total += 1
+        if framer is not None:
+            self.active.seen = (framer.frames_total, framer.checksum_fail)
+        logger.info("failover: receive from {}".format(self.active.mode))
+
+        for link in self.links:
+            if link.conn is None:
+                threading.Thread(target=self._reopen, args=(link,), daemon=True).start()
+
+        now = time.monotonic()
+        self._check_time = now
+        self._window_time = now + FAILOVER_WINDOW
+
+    def _open(self, link):
+        if link.mode == "socket":
+            logger.info("initialize socket (failover)...")
+            conn = SDSSocket()
+        else:
+            logger.info("initialize serial (failover)...")
+            conn = SDSSerial()
+
+        # standby로 붙으므로 받다 만 데이터는 버리고 (카운터는 유지), 연결은 마지막에 붙여야 메인 스레드가 중간 상태를 보지 않음
+        link.framer.attach(link)
+        link.seen = (link.framer.frames_total, link.framer.checksum_fail)
+        link.last_recv = time.monotonic()
+        link.conn = conn
+
+    def _reopen(self, link):
+        # 끊어진 경로는 별도 스레드에서 다시 열어서 standby로 붙임
+        attempt = 0
+        while not self._closed:
+            time.sleep(conn_reconnect_delay(attempt))
+            attempt += 1
+            try:
+                self._open(link)
+            except (RuntimeError, OSError) as e:
+                logger.warning("failover: {} link reopen failed: {}".format(link.mode, e))
+                continue
+
+            if self._closed:
+                link.conn.close()
+            else:
+                logger.info("failover: {} link reopened".format(link.mode))
+            return
+
+    def _down(self, link, error):
+        logger.warning("failover: {} link lost: {}".format(link.mode, error))
+        conn, link.conn = link.conn, None
+        try:
+            conn.close()
+        except Exception as e:
+            logger.warning("close failed! ({})".format(e))
+
+        if link is self.active:
+            link.collect(framer)
+            standby = self._standby()
+            if standby:
+                self._switch(standby, "link lost")
+            else:
+                self.active = None
+
+        threading.Thread(target=self._reopen, args=(link,), daemon=True).start()
+
+    def _standby(self):
+        for link in self.links:
+            if link is not self.active and link.conn is not None:
+                return link
+        return None
+
+    def _switch(self, link, reason):
+        old = self.active
+        logger.warning("failover: switch {} -> {} ({})".format(old.mode, link.mode, reason))
+
+        # 지금까지의 checksum 결과를 나눠 담고, 서로 역할을 바꿔서 다시 셈
+        if old.conn is not None:
+            old.collect(framer)
+            old.framer.attach(old)
+            old.seen = (old.framer.frames_total, old.framer.checksum_fail)
+        link.collect(link.framer)
+        link.seen = (framer.frames_total, framer.checksum_fail)
+        old.window = [0, 0]
+        link.window = [0, 0]
+
+        self.active = link
+        link.active_total += 1
+        self.switch_total += 1
+
+    def _drain(self, link):
+        # standby: 도착한 만큼 읽고, 길이를 알 수 있는 패킷만 checksum 확인 (처리는 하지 않음)
+        f = link.framer
+        f.fill_nowait()
+        while True:
+            mark = f.mark()
+            header = f.get_header_nowait()
+            if not header:
+                break
+
+            flags, info, need = serial_dispatch[(header[0] << 8) | header[1]]
+            if len(f) < need:
+                f.rewind(mark)
+                break
+
+            if flags & (DISPATCH_STATE | DISPATCH_QUERY):
+                f.recv_frame(info[1])
+
+    def _check(self, now):
+        self._check_time = now + self._stall / 4
+        active = self.active
+        standby = self._standby()
+
+        # 구간마다 checksum 결과를 모아서 성공률 비교
+        ratio = None
+        if now >= self._window_time:
+            self._window_time = now + FAILOVER_WINDOW
+            active.collect(framer)
+            if standby:
+                standby.collect(standby.framer)
+                ratio = [ok / (ok + fail) if ok + fail >= FAILOVER_MIN_FRAMES else None for ok, fail in (active.window, standby.window)]
+                standby.window = [0, 0]
+            active.window = [0, 0]
+
+        if not standby:
+            return
+
+        # active는 조용한데 standby로는 계속 들어오는 경우
+        if now - active.last_recv > self._stall and now - standby.last_recv < self._stall:
+            self._switch(standby, "no data for {:.0f} ms".format((now - active.last_recv) * 1000))
+
+        elif ratio and None not in ratio and ratio[0] < self._ratio <= ratio[1]:
+            self._switch(standby, "checksum ok {:.0%} vs {:.0%}".format(*ratio))
+
+        # standby만 오래 조용하면 (EW11 연결이 멈춘 경우 등) 다시 연결
+        elif now - standby.last_recv > self._timeout and now - active.last_recv < self._stall:
+            self._down(standby, "no data for {:.0f} seconds".format(now - standby.last_recv))
+
+    def recv_into(self, view, count=1):
+        # 두 경로를 같이 기다려서, active에서 온 것만 돌려주고 standby는 확인만 하고 버림
+        # select로 읽을 수 있는 것을 확인하고 읽으므로, count는 무시 (부족하면 framer가 다시 부름)
+        deadline = time.monotonic() + self._timeout
+        while True:
+            if self.active is None:
+                raise RuntimeError("failover: all links lost!")
+
+            links = [link for link in self.links if link.conn is not None]
+            now = time.monotonic()
+            readable, _, _ = select.select(links, [], [], max(min(self._check_time, deadline) - now, 0))
+
+            n = 0
+            for link in readable:
+                try:
+                    if link is self.active:
+                        n = link.recv_into(view, 1)
+                    else:
+                        self._drain(link)
+                except (RuntimeError, OSError) as e:
+                    self._down(link, e)
+
+            now = time.monotonic()
+            if self.active and now >= self._check_time:
+                self._check(now)
+
+            if n:
+                return n
+            if not readable and now >= deadline:
+                raise RuntimeError("failover: no active packet on any link!")
+
+    def send(self, a):
+        # 명령은 active로만 보냄, 보내다 끊기거나 잠깐 둘 다 끊긴 경우는 대기열 재시도에 맡김
+        link = self.active
+        if link is None:
+            return
+        try:
+            link.conn.send(a)
+        except (RuntimeError, OSError) as e:
+            # standby가 있으면 _down에서 바로 넘어감
+            self._down(link, e)
+
+    def close(self):
+        self._closed = True
+        for link in self.links:
+            if link.conn is not None:
+                link.conn.close()
+
+    def fileno(self):
+        # 둘 다 끊긴 동안은 닫힌 socket처럼 -1
+        return self.active.fileno() if self.active else -1
+
+    def check_in_waiting(self):
+        return self.active.check_in_waiting() if self.active else 0
+
+    def set_timeout(self, a):
+        self._timeout = a
+
+
+class SDSRecorder:
+    # 받은/보낸 데이터를 그대로 전달하면서 시각과 함께 capture 파일에 기록
+    def __init__(self, conn, filename):
+        self._conn = conn
+
+        # 재시작하면서 이전 기록을 덮어쓰지 않도록 하나만 보관
+        if os.path.exists(filename):
+            os.replace(filename, filename + ".1")
+
+        self._file = open(filename, "wb")
+        self._file.write(CAPTURE_HEADER.pack(CAPTURE_MAGIC, time.time()))
+        self._last = time.monotonic()
+        self._flush_time = self._last
+
+        # 1초마다만 flush 하므로, 종료할 때 마지막 부분이 남도록 닫아줌
+        atexit.register(self._file.close)
+
+    def _write(self, data, flags):
+        now = time.monotonic()
+        interval = min(int((now - self._last) * 1000000), 0xFFFFFFFF)
+        self._last = now
+
+        self._file.write(CAPTURE_RECORD.pack(interval, flags | len(data)))
+        self._file.write(data)
+
+        if now - self._flush_time > 1:
+            self._file.flush()
+            self._flush_time = now
+
+    def recv_into(self, view, count=1):
+        n = self._conn.recv_into(view, count)
+        self._write(view[:n], 0)
+        return n
+
+    def send(self, a):
+        self._conn.send(a)
+        self._write(a, CAPTURE_TX)
+
+    def attach(self, conn):
+        # 재접속해도 같은 파일에 이어서 기록
+        self._conn = conn
+
+    def close(self):
+        self._file.flush()
+        self._conn.close()
+
+    def fileno(self):
+        return self._conn.fileno()
+
+    def check_in_waiting(self):
+        return self._conn.check_in_waiting()
+
+    def set_timeout(self, a):
+        self._conn.set_timeout(a)
+
+
+class SDSGateway:
+    # 받은/보낸 데이터를 그대로 전달하면서, 같은 내용을 TCP 클라이언트들에게도 보냄 (ser2net 처럼, 기본은 읽기 전용)
+    # 공유 버퍼 하나에 한번만 복사해두고, 클라이언트마다 자기 위치에서 memoryview로 보낸다.
+    # 버퍼 크기보다 더 뒤처진 클라이언트는 끊어서, bus 읽는 쪽은 클라이언트 때문에 기다리지 않음
+    def __init__(self, port, writable, size=65536):
+        # 포트를 못 열면 (다른 프로그램이 사용 중 등) 아무것도 만들지 않고 OSError
+        self._server = socket.socket()
+        try:
+            self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._server.bind(("", port))
+            self._server.listen(4)
+        except OSError:
+            self._server.close()
+            raise
+
+        self._conn = None
+        self._writable = writable
+        self._size = size
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._written = 0  # 지금까지 쓴 전체 byte 수, 버퍼 위치는 size로 나눈 나머지
+
+        # 클라이언트 socket: 지금까지 보낸 전체 byte 수
+        self._clients = {}
+        self._rx = queue.SimpleQueue()
+
+        # 새 데이터가 있으면 보내는 스레드를 깨움, 이미 깨워뒀으면 다시 하지 않음
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_w.setblocking(False)
+        self._wake = False
+
+        # metrics용 카운터
+        self.dropped = 0
+
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def _feed(self, data):
+        if not self._clients:
+            return
+
+        n = len(data)
+        if n > self._size:
+            self._written += n - self._size
+            data = data[-self._size:]
+            n = self._size
+
+        pos = self._written % self._size
+        first = min(n, self._size - pos)
+        self._view[pos:pos + first] = data[:first]
+        if first < n:
+            self._view[:n - first] = data[first:]
+        self._written += n
+
+        if not self._wake:
+            self._wake = True
+            try:
+                self._wake_w.send(b"\0")
+            except BlockingIOError:
+                pass
+
+    def _drop(self, sock, reason):
+        logger.warning("gateway: drop client ({})".format(reason))
+        self.dropped += 1
+        self._close(sock)
+
+    def _close(self, sock):
+        self._clients.pop(sock, None)
+        sock.close()
+
+    def _send(self, sock):
+        sent = self._clients[sock]
+        end = self._written
+        if end - sent > self._size:
+            self._drop(sock, "too slow")
+            return
+
+        pos = sent % self._size
+        try:
+            n = sock.send(self._view[pos:pos + min(end - sent, self._size - pos)])
+        except BlockingIOError:
+            n = 0
+        except OSError as e:
+            self._drop(sock, e)
+            return
+
+        # 보내는 동안 덮어써졌을 수 있으면 끊음
+        if self._written - sent > self._size:
+            self._drop(sock, "too slow")
+            return
+        self._clients[sock] = sent + n
+
+    def _accept(self):
+        try:
+            client, addr = self._server.accept()
+        except OSError as e:
+            # 연결 직후 끊긴 클라이언트 (ECONNABORTED), fd 부족 (EMFILE) 등: gateway는 계속 동작
+            # fd 부족은 계속 readable이므로, 다른 클라이언트가 끊길 때까지 잠깐씩 쉬면서 다시 시도
+            logger.warning("gateway: accept failed ({})".format(e))
+            time.sleep(1)
+            return
+
+        try:
+            client.setblocking(False)
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            # OS 버퍼에 너무 많이 쌓이지 않게 해서, 느린 클라이언트는 공유 버퍼 크기만큼 뒤처지면 끊기도록
+            client.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 16384)
+        except OSError as e:
+            logger.warning("gateway: client setup failed {} ({})".format(addr, e))
+            client.close()
+            return
+
+        self._clients[client] = self._written
+        logger.info("gateway: client connected {}".format(addr))
+
+    def _loop(self):
+        while True:
+            clients = list(self._clients)
+            pending = [sock for sock in clients if self._clients[sock] < self._written]
+            try:
+                readable, writable, _ = select.select([self._server, self._wake_r] + clients, pending, [])
+            except OSError as e:
+                logger.warning("gateway: select failed ({})".format(e))
+                time.sleep(1)
+                continue
+
+            for sock in readable:
+                if sock is self._server:
+                    self._accept()
+
+                elif sock is self._wake_r:
+                    # 비운 다음에 풀어야, 그 사이에 깨운 것을 놓치지 않음
+                    sock.recv(256)
+                    self._wake = False
+
+                else:
+                    try:
+                        data = sock.recv(256)
+                    except OSError:
+                        data = None
+                    if not data:
+                        logger.info("gateway: client disconnected")
+                        self._close(sock)
+                    elif self._writable:
+                        self._rx.put(data)
+
+            for sock in writable:
+                if sock in self._clients:
+                    self._send(sock)
+
+    def attach(self, conn):
+        # 재접속하면 안쪽 연결만 바꿈, 클라이언트 연결은 유지
+        self._conn = conn
+
+    def recv_into(self, view, count=1):
+        # writable이면 클라이언트가 보낸 데이터를 bus 처리 스레드에서 보냄 (우리 명령과 섞이지 않도록)
+        if self._writable:
+            while not self._rx.empty():
+                self.send(self._rx.get())
+
+        n = self._conn.recv_into(view, count)
+        self._feed(view[:n])
+        return n
 
+    def send(self, a):
+        self._conn.send(a)
+        self._feed(a)
+
+    @property
+    def clients(self):
+        return len(self._clients)
+
+    def close(self):
+        self._conn.close()
+
+    def fileno(self):
+        return self._conn.fileno()
+
+    def check_in_waiting(self):
+        return self._conn.check_in_waiting()
+
+    def set_timeout(self, a):
+        self._conn.set_timeout(a)
+
+
+class SDSReplay:
+    # capture 파일에서 받은 데이터만 다시 흘려보냄, 보내는 데이터는 버림
+    def __init__(self):
+        filename = Options["capture"]["filename"]
+        self._realtime = Options["capture"]["realtime"]
+
+        with open(filename, "rb") as f:
+            data = memoryview(f.read())
+
+        magic, start = CAPTURE_HEADER.unpack_from(data)
+        if magic != CAPTURE_MAGIC:
+            raise RuntimeError("{} is not a capture file!".format(filename))
+        logger.info("replay {} recorded at {}".format(filename, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(start))))
+
+        # (캡처 시작부터의 시각, data) 목록
+        self._chunks = []
+        t = 0
+        pos = CAPTURE_HEADER.size
+        while pos + CAPTURE_RECORD.size <= len(data):
+            interval, flags = CAPTURE_RECORD.unpack_from(data, pos)
+            pos += CAPTURE_RECORD.size
+            size = flags & ~CAPTURE_TX
+            t += interval / 1000000
+            if not flags & CAPTURE_TX:
+                self._chunks.append((t, data[pos:pos+size]))
+            pos += size
+
+        self._index = 0
+        self._offset = 0
+        self._bytes = 0
+        self.sent = 0
+
+        self._start = time.monotonic()
+        self._cpu_start = time.process_time()
+
+    def _finish(self):
+        wall = time.monotonic() - self._start
+        cpu = time.process_time() - self._cpu_start
+        logger.info("replay finished: {} bytes, {:.3f}s elapsed, {:.3f}s cpu, {} sends dropped".format(self._bytes, wall, cpu, self.sent))
+        raise RuntimeError("replay finished!")
+
+    def recv_into(self, view, count=1):
+        # 실제 장치처럼, 도착해 있는 만큼 읽고 부족하면 count Byte 올 때까지 대기
+        size = min(max(self.check_in_waiting(), count), len(view))
+        n = 0
+        while n < size:
+            if self._index >= len(self._chunks):
+                if n:
+                    break
+                self._finish()
+
+            t, chunk = self._chunks[self._index]
+            if self._realtime:
+                wait = self._start + t - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+
+            k = min(len(chunk) - self._offset, size - n)
+            view[n:n+k] = chunk[self._offset:self._offset+k]
+            n += k
+            self._offset += k
+            if self._offset == len(chunk):
+                self._index += 1
+                self._offset = 0
+
+        self._bytes += n
+        return n
+
+    def send(self, a):
+        self.sent += 1
+
+    def close(self):
+        pass
+
+    def fileno(self):
+        # 파일에서 읽으므로 기다릴 fd가 없음 (replay는 blocking loop_mode만 지원)
+        return -1
+
+    def check_in_waiting(self):
+        # 기록할 때 한번에 읽혔던 덩어리 단위로 도착한 것으로 봄 (덩어리 사이는 bus가 조용했던 시점)
+        if self._index >= len(self._chunks):
+            return 0
+
+        t, chunk = self._chunks[self._index]
+        if self._realtime and self._start + t > time.monotonic():
+            return 0
+        return len(chunk) - self._offset
+
+    def set_timeout(self, a):
+        pass
+
+
+class SDSRingBuffer:
+    # 미리 할당한 버퍼를 recv_into로 채우고, 읽을 때는 memoryview로 복사 없이 넘겨준다.
+    # 쓰는 위치가 끝에 닿으면 아직 안 읽은 몇 Byte(패킷 하나 미만)만 앞으로 옮기고 처음부터 다시 채운다.
+    # 넘겨준 memoryview는 다음 fill 전까지만 유효하므로, 보관하려면 bytes로 바꿔야 한다.
+    def __init__(self, size=4096, keep=2):
+        self._buf = bytearray(size)
+        self.view = memoryview(self._buf)
+        self.head = 0
+        self.tail = 0
+
+        # 이미 읽은 부분 중 앞으로 옮길 때 같이 남겨둘 크기 (recv_frame에서 header까지 한번에 넘기기 위함)
+        self._keep = keep
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def fill(self, conn, count=1):
+        # 끝에 남은 공간이 부족하면 처음으로 돌아감
+        if len(self._buf) - self.tail < max(count, 256):
+            start = max(self.head - self._keep, 0)
+            size = self.tail - start
+            self.view[0:size] = self.view[start:self.tail]
+            self.head -= start
+            self.tail = size
+
+        n = conn.recv_into(self.view[self.tail:], count)
+        self.tail += n
+        return n
+
+
+class SDSFramer:
+    # 첫 Byte만 0x80보다 큰 두 Byte, 연속으로 0x80보다 큰 byte가 나오면 먼젓번은 무시한다.
+    # (가장 왼쪽에서 매칭되므로 자연스럽게 연속된 것 중 마지막 byte가 header_0이 됨)
+    HEADER_PATTERN = re.compile(rb"[\x80-\xff][\x00-\x7f]")
+
+    def __init__(self, conn):
+        # metrics용 카운터
+        self.bytes_total = 0
+        self.frames_total = 0
+        self.checksum_fail = 0
+
+        self.attach(conn)
+
+    def attach(self, conn):
+        # 재접속하면 새 연결로 바꾸고, 끊기기 전에 받다 만 데이터는 버림 (카운터는 유지)
+        self._conn = conn
+        self._ring = SDSRingBuffer()
+        self._pending_recv = 0
+
+        # 수신 대기할 때 select 할 연결 (failover면 fd가 바뀌므로 매번 fileno()로 확인), 지원하지 않으면 예전처럼 확인만 반복
+        self._fd = conn if hasattr(conn, "fileno") else None
+
+    def _fill(self, count=1):
+        self.bytes_total += self._ring.fill(self._conn, count)
+
+    def _consume(self, count):
+        self._ring.head += count
         self._pending_recv = max(self._pending_recv - count, 0)
 
-        res = self._recv_buf[0:count]
-        del self._recv_buf[0:count]
+    def _search_header(self):
+        ring = self._ring
+        m = self.HEADER_PATTERN.search(ring.view, ring.head, ring.tail)
+        if m:
+            start = m.start()
+            self._consume(start + 2 - ring.head)
+            return ring.view[start], ring.view[start + 1]
+
+        # 못 찾았으면 마지막 byte만 (header_0 일 수 있으니) 남기고 버림
+        end = ring.tail
+        if end > ring.head and ring.view[end - 1] >= 0x80:
+            end -= 1
+        self._consume(end - ring.head)
+        return None
+
+    def get_header(self):
+        while True:
+            header = self._search_header()
+            if header:
+                return header
+            self._fill()
+
+    def get_header_nowait(self):
+        # asyncio 모드: 기다리지 않고, 버퍼에 header가 없으면 None
+        return self._search_header()
+
+    def fill_nowait(self):
+        # asyncio 모드: 읽을 수 있다고 알려왔을 때 도착한 만큼만 읽음
+        self._fill()
+
+    def mark(self):
+        return self._ring.head, self._pending_recv
+
+    def rewind(self, mark):
+        # 패킷이 아직 덜 왔으면 header 찾기 전으로 되돌려서 다음에 다시 처리
+        self._ring.head, self._pending_recv = mark
+
+    def __len__(self):
+        return len(self._ring)
+
+    def recv(self, count=1):
+        ring = self._ring
+        while len(ring) < count:
+            self._fill(count - len(ring))
+
+        res = ring.view[ring.head:ring.head + count]
+        self._consume(count)
         return res
 
-    def send(self, a):
-        self._soc.sendall(a)
+    def recv_frame(self, remain):
+        # 방금 찾은 header에 이어서 remain 만큼 읽고, checksum까지 확인한 패킷 반환 (memoryview)
+        ring = self._ring
+        while len(ring) < remain:
+            self._fill(remain - len(ring))
+
+        packet = ring.view[ring.head - 2:ring.head + remain]
+        self._consume(remain)
+
+        # checksum 오류 없는지 확인
+        if not serial_verify_checksum(packet):
+            self.checksum_fail += 1
+            return None
+        self.frames_total += 1
+        return packet
+
+    def wait_in_waiting(self, count, timeout):
+        # count Byte가 도착할 때까지 fd를 select로 기다림 (CPU 점유 없이), 시간 내에 안오면 False
+        ring = self._ring
+        deadline = time.monotonic() + timeout
+        while len(ring) < count:
+            # 이미 도착한 만큼은 버퍼로 옮겨야 select가 계속 깨어나지 않음
+            if self._conn.check_in_waiting():
+                self._fill()
+                continue
+
+            remain = deadline - time.monotonic()
+            if remain <= 0:
+                return False
+            if self._fd is not None:
+                select.select([self._fd], [], [], remain)
+
+        return True
 
     def set_pending_recv(self):
-        self._pending_recv = len(self._recv_buf)
+        self._pending_recv = self.check_in_waiting()
 
     def check_pending_recv(self):
         return self._pending_recv
 
     def check_in_waiting(self):
-        if len(self._recv_buf) == 0:
-            new_data = self._recv_raw(256)
-            self._recv_buf.extend(new_data)
-        return len(self._recv_buf)
+        return len(self._ring) + self._conn.check_in_waiting()
+
+
+class SDSTimerWheel:
+    # 해시 타이머 휠 (monotonic 기준): 만료 tick으로 slot을 정해 넣어두고, tick마다 그 slot만 확인한다.
+    # 추가/취소는 O(1), 한 바퀴보다 먼 timer는 다음 바퀴까지 slot에 남아있음. 취소는 callback만 지워두고 만료 때 버림
+    def __init__(self, tick=0.05, size=1024):
+        self.tick = tick
+        self._size = size
+        self._slots = [[] for _ in range(size)]
+        self._current = int(time.monotonic() / tick)
+        self._lock = threading.Lock()
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, delay, callback, *args):
+        # 늦게 만료되는 건 괜찮지만 일찍 만료되면 안되므로 올림
+        expire = math.ceil((time.monotonic() + delay) / self.tick)
+        timer = [expire, callback, args]
+        with self._lock:
+            timer[0] = expire = max(expire, self._current + 1)
+            self._slots[expire % self._size].append(timer)
+            self._count += 1
+        return timer
+
+    @staticmethod
+    def cancel(timer):
+        timer[1] = None
+
+    def advance(self):
+        # 지난 tick의 slot들을 확인해서 만료된 timer를 lock 밖에서 실행
+        now = int(time.monotonic() / self.tick)
+        due = []
+        with self._lock:
+            while self._current < now:
+                self._current += 1
+                index = self._current % self._size
+                slot = self._slots[index]
+                if not slot:
+                    continue
+
+                keep = []
+                for timer in slot:
+                    if timer[0] > self._current:
+                        keep.append(timer)
+                    else:
+                        self._count -= 1
+                        due.append(timer)
+                self._slots[index] = keep
+
+        for timer in due:
+            callback = timer[1]
+            if callback is None:
+                continue
+            try:
+                callback(*timer[2])
+            except Exception as e:
+                logger.exception("timer callback failed! ({})".format(e))
+
+
+class SDSCommand:
+    __slots__ = ("priority", "seq", "key", "packet", "enqueue_time", "deadline", "first_send", "sends", "ready", "backoff", "timer")
+
+    def __init__(self, priority, seq, key, packet, retry):
+        self.priority = priority
+        self.seq = seq
+        self.key = key
+        self.ready = True
+        self.timer = None
+        self.set_packet(packet, retry)
+
+    def set_packet(self, packet, retry):
+        now = time.monotonic()
+        self.packet = packet
+        self.enqueue_time = now
+        self.deadline = now + retry
+
+        # 지연시간 통계, 재시도 간격
+        self.first_send = None
+        self.sends = 0
+        self.backoff = 0
+
+
+class SDSCommandQueue:
+    # 장치로 보낼 명령 대기열: (device, id, 명령) 별로 하나만 유지하고, 새 값이 오면 기다리던 값을 대체한다.
+    # 우선순위(작을수록 먼저)가 같으면 먼저 들어온 순서대로 보낸다.
+    # timer wheel이 있으면 max_retry가 지난 명령은 버스 상황과 상관없이 지우고 (on_expire 호출),
+    # 재시도 간격을 벌린 명령은 그동안 보낼 대상에서 빠진다 (ready).
+    # MQTT 스레드에서 넣고 serial/timer 스레드에서 빼므로 lock으로 보호
+    def __init__(self, size, timers=None, on_expire=None):
+        self._size = size
+        self._entries = {}  # key: SDSCommand
+        self._keys = {}     # packet: {key, ...} (debug 명령이 장치 명령과 같은 패킷일 수 있음)
+        self._seq = 0
+        self._ready = 0
+        self._timers = timers
+        self._on_expire = on_expire
+        self._lock = threading.Lock()
+
+    def __bool__(self):
+        return self._ready > 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _link(self, entry):
+        self._keys.setdefault(entry.packet, set()).add(entry.key)
+
+    def _unlink(self, entry):
+        keys = self._keys.get(entry.packet)
+        if keys:
+            keys.discard(entry.key)
+            if not keys:
+                del self._keys[entry.packet]
+
+    def _remove(self, entry):
+        self._entries.pop(entry.key, None)
+        self._unlink(entry)
+        if entry.ready:
+            self._ready -= 1
+        if entry.timer:
+            self._timers.cancel(entry.timer)
+
+    def _schedule(self, entry):
+        if self._timers is not None:
+            if entry.timer:
+                self._timers.cancel(entry.timer)
+            entry.timer = self._timers.add(entry.deadline - time.monotonic(), self._expire, entry, entry.deadline)
+
+    def push(self, key, packet, priority, retry):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                # 아직 못 보낸 이전 값은 버리고, 순서는 유지
+                logger.info("replace command: %s -> %s", entry.packet.hex(), packet.hex())
+                self._unlink(entry)
+                entry.priority = min(entry.priority, priority)
+                entry.set_packet(packet, retry)
+                if not entry.ready:
+                    entry.ready = True
+                    self._ready += 1
+                self._link(entry)
+                self._schedule(entry)
+                return True
+
+            if len(self._entries) >= self._size:
+                # 가득 찼으면, 새 명령보다 우선순위가 낮은 것 중 가장 나중에 들어온 것을 밀어냄
+                worst = max(self._entries.values(), key=lambda entry: (entry.priority, entry.seq))
+                if worst.priority <= priority:
+                    logger.error("command queue full! drop {}".format(packet.hex()))
+                    return False
+
+                logger.warning("command queue full! drop {}".format(worst.packet.hex()))
+                self._remove(worst)
+
+            self._seq += 1
+            entry = self._entries[key] = SDSCommand(priority, self._seq, key, packet, retry)
+            self._link(entry)
+            self._ready += 1
+            self._schedule(entry)
+            return True
+
+    def peek(self):
+        # 다음에 보낼 명령, 그 사이 다른 스레드에서 만료됐으면 None
+        with self._lock:
+            return min((entry for entry in self._entries.values() if entry.ready), key=lambda entry: (entry.priority, entry.seq), default=None)
+
+    def pop(self, packet):
+        # 같은 패킷을 기다리던 명령은 ack 하나로 모두 끝남, 실제로 보냈던 것을 돌려줌 (지연시간 통계)
+        with self._lock:
+            keys = self._keys.get(packet)
+            if not keys:
+                return None
+
+            entries = [self._entries[key] for key in list(keys)]
+            for entry in entries:
+                self._remove(entry)
+            return max(entries, key=lambda entry: entry.sends)
+
+    def hold(self, entry, delay):
+        # 재시도 간격 벌리기: delay 동안 보낼 대상에서 빼뒀다가 timer로 되돌림
+        if self._timers is None:
+            return
+        with self._lock:
+            if self._entries.get(entry.key) is not entry or not entry.ready:
+                return
+            entry.ready = False
+            self._ready -= 1
+        self._timers.add(delay, self._resume, entry, entry.deadline)
+
+    def _resume(self, entry, deadline):
+        with self._lock:
+            if self._entries.get(entry.key) is entry and entry.deadline == deadline and not entry.ready:
+                entry.ready = True
+                self._ready += 1
+
+    def _expire(self, entry, deadline):
+        with self._lock:
+            if self._entries.get(entry.key) is not entry or entry.deadline != deadline:
+                return
+            entry.timer = None
+            self._remove(entry)
+        if self._on_expire:
+            self._on_expire(entry)
+
+
+class SDSPublishQueue:
+    # MQTT publish 대기열: topic별로 가장 최근 값 하나만 유지, 가득 차면 가장 오래된 상태 값을 버림
+    # (discovery, availability는 다시 보내지 않으므로 버리지 않음, 장치 수만큼이라 크기 제한을 넘어도 됨)
+    # serial 스레드에서 넣고 publish 전용 worker (asyncio 모드에서는 event loop)가 꺼내서 보낸다
+    def __init__(self, size):
+        self._size = size
+        self._entries = {}  # topic: payload
+        self._cond = threading.Condition()
+        self.coalesced = 0
+        self.dropped = 0
+
+        # 비어있다가 새로 들어왔을 때 꺼낼 쪽을 깨우는 함수 (asyncio 모드)
+        self.notify = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _keep(topic):
+        return topic.startswith("homeassistant/") or topic.endswith("/available")
+
+    def push(self, topic, payload):
+        with self._cond:
+            entries = self._entries
+            wake = not entries
+
+            if topic in entries:
+                # 아직 못 보낸 이전 값은 버리고, 순서는 유지
+                self.coalesced += 1
+            elif len(entries) >= self._size:
+                oldest = next((t for t in entries if not self._keep(t)), None)
+                if oldest is None and not self._keep(topic):
+                    # 버릴 수 있는 것 중에서는 새 값이 가장 오래된 셈
+                    oldest = topic
+                if oldest is not None:
+                    logger.warning("publish queue full! drop {}".format(oldest))
+                    entries.pop(oldest, None)
+                    self.dropped += 1
+                    if oldest is topic:
+                        return
+
+            entries[topic] = payload
+            self._cond.notify()
+
+        if wake and self.notify:
+            self.notify()
+
+    def take(self, timeout=None):
+        # 쌓인 것을 한번에 꺼냄, 비어 있으면 timeout 동안 기다림
+        with self._cond:
+            if not self._entries and timeout != 0:
+                self._cond.wait(timeout)
+            entries, self._entries = self._entries, {}
+        return entries
+
+
+class SDSLatency:
+    # 로그 스케일 bucket 히스토그램: 1ms부터 25%씩 커지는 구간, 약 2분까지
+    BUCKETS = [0.001 * 1.25 ** i for i in range(56)]
 
-    def set_timeout(self, a):
-        self._soc.settimeout(a)
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.retries = 0
+        self.max_retries = 0
+
+    def add(self, seconds, retries=0):
+        self.counts[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        self.n += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.retries += retries
+        self.max_retries = max(self.max_retries, retries)
+
+    def percentile(self, q):
+        # 해당 bucket의 상한값 (실제 값보다 최대 25% 크게 나올 수 있음)
+        target = q * self.n
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target and i < len(self.BUCKETS):
+                return min(self.BUCKETS[i], self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "n": self.n,
+            "p50": round(self.percentile(0.50) * 1000, 1),
+            "p95": round(self.percentile(0.95) * 1000, 1),
+            "p99": round(self.percentile(0.99) * 1000, 1),
+            "max": round(self.max * 1000, 1),
+            "avg": round(self.total / self.n * 1000, 1) if self.n else 0,
+            "retry_avg": round(self.retries / self.n, 2) if self.n else 0,
+            "retry_max": self.max_retries,
+        }
+
+
+class SDSLogQueueHandler(QueueHandler):
+    # 기본 QueueHandler는 넣기 전에 message를 만들어버리므로, record 그대로 넘겨서 포맷팅도 listener 스레드에서 하게 함
+    # (같은 프로세스 안에서만 쓰고, 인자는 모두 문자열이나 숫자로 넘김)
+    def prepare(self, record):
+        return record
+
+
+class SDSLogDedup(logging.Filter):
+    # 같은 형식, 같은 첫번째 인자(topic, 패킷)의 INFO 로그는 interval 동안 한번만 남기고, 다음에 남길 때 생략한 개수를 붙임
+    def __init__(self, interval):
+        super().__init__()
+        self._interval = interval
+        self._last = {}  # (형식, 첫번째 인자): [시각, 생략한 개수]
+
+    def filter(self, record):
+        if record.levelno > logging.INFO or not record.args:
+            return True
+
+        key = (record.msg, record.args[0])
+        last = self._last.get(key)
+        if last and record.created - last[0] < self._interval:
+            last[1] += 1
+            return False
+
+        if last and last[1]:
+            record.msg += " (%d similar skipped)"
+            record.args += (last[1],)
+        self._last[key] = [record.created, 0]
+        return True
+
+
+class SDSLogPrefix(logging.Filter):
+    # 여러 bus 모드: 어느 bus의 로그인지 앞에 붙임
+    def __init__(self, prefix):
+        super().__init__()
+        self._prefix = "[{}] ".format(prefix)
+
+    def filter(self, record):
+        record.msg = self._prefix + str(record.msg)
+        return True
+
+
+class SDSLogListener(QueueListener):
+    # 포맷팅과 파일 쓰기는 이 스레드에서, dedup도 handler마다가 아니라 한번만
+    def __init__(self, queue, handlers, dedup):
+        super().__init__(queue, *handlers, respect_handler_level=True)
+        self._dedup = dedup
+
+    def handle(self, record):
+        if self._dedup and not self._dedup.filter(record):
+            return
+        super().handle(record)
 
 
 def init_logger():
@@ -536,6 +1843,28 @@ def init_logger_file():
         logger.addHandler(handler)
 
 
+def init_logger_queue():
+    # serial 처리 중에 로그 포맷팅, 파일 쓰기(SD 카드 등) 때문에 늦어지지 않도록 별도 스레드로 넘김
+    interval = Options["log"]["dedup_interval"]
+    dedup = SDSLogDedup(interval) if interval > 0 else None
+
+    if not Options["log"]["queue"]:
+        if dedup:
+            logger.addFilter(dedup)
+        return
+
+    handlers = logger.handlers[:]
+    for handler in handlers:
+        logger.removeHandler(handler)
+
+    q = queue.SimpleQueue()
+    logger.addHandler(SDSLogQueueHandler(q))
+
+    listener = SDSLogListener(q, handlers, dedup)
+    listener.start()
+    atexit.register(listener.stop)
+
+
 def init_option(argv):
     # option 파일 선택
     if len(argv) == 1:
@@ -579,6 +1908,51 @@ def init_option(argv):
     Options["mqtt"]["_discovery"] = Options["mqtt"]["discovery"]
 
 
+def init_timer():
+    global timer_wheel
+    timer_wheel = SDSTimerWheel(TIMER_TICK)
+
+
+def init_command_queue():
+    global serial_queue
+    serial_queue = SDSCommandQueue(Options["rs485"]["max_queue"], timer_wheel, serial_expired.append)
+
+
+def init_publish_queue():
+    global publish_queue
+    publish_queue = SDSPublishQueue(Options["mqtt"]["max_queue"])
+
+
+def init_cache():
+    # 이전 실행에서 저장한 상태를 읽어두고, MQTT 접속 후 mqtt_init_discovery에서 적용한다
+    global cache_pending, HEADER_0_FIRST
+
+    # replay는 실제 설치 환경과 다르므로 읽지도 쓰지도 않음
+    Options["cache"]["_enable"] = Options["cache"]["enable"] and Options["serial_mode"] != "replay"
+    if not Options["cache"]["_enable"]:
+        return
+
+    filename = Options["cache"]["filename"]
+    try:
+        with open(filename) as f:
+            cache = json.load(f)
+
+        if cache.get("version") != CACHE_VERSION or cache.get("prefix") != Options["mqtt"]["prefix"]:
+            logger.warning("ignore cache {}: version or prefix mismatch".format(filename))
+        else:
+            cache_pending = cache
+            HEADER_0_FIRST = cache["header_0_first"]
+            logger.info("load cache {} (saved {:.0f} min ago)".format(filename, (time.time() - os.path.getmtime(filename)) / 60))
+
+    except FileNotFoundError:
+        logger.info("no cache {}, cold start...".format(filename))
+    except Exception as e:
+        logger.warning("ignore broken cache {} ({})".format(filename, e))
+
+    threading.Thread(target=cache_loop, daemon=True).start()
+    atexit.register(cache_save)
+
+
 def init_virtual_device():
     global virtual_watch
 
@@ -623,17 +1997,42 @@ def init_virtual_device():
             VIRTUAL_DEVICE["intercom"]["trigger"]["public"]["next"] = ("pubdelay1", "ON")
 
 
+def mqtt_publish(topic, payload):
+    # bus 처리 중에 broker 때문에 늦어지지 않도록, 대기열에 넣기만 한다
+    if publish_queue is None:
+        mqtt.publish(topic, payload)
+    else:
+        publish_queue.push(topic, payload)
+
+
+def mqtt_publish_drain(entries=None):
+    if entries is None:
+        entries = publish_queue.take(0)
+
+    for topic, payload in entries.items():
+        try:
+            mqtt.publish(topic, payload)
+        except Exception as e:
+            logger.warning("publish failed: {} ({})".format(topic, e))
+
+
+def mqtt_publish_loop():
+    while True:
+        mqtt_publish_drain(publish_queue.take())
+
+
 def mqtt_discovery(payload):
     intg = payload.pop("_intg")
 
-    # MQTT 통합구성요소에 등록되기 위한 추가 내용
+    # MQTT 통합구성요소에 등록되기 위한 추가 내용 (bus별 prefix의 / 는 id에 쓸 수 없음)
     payload["device"] = DISCOVERY_DEVICE
+    payload["obj_id"] = payload["obj_id"].replace("/", "_")
     payload["uniq_id"] = payload["obj_id"]
 
     # discovery에 등록
     topic = "homeassistant/{}/sds_wallpad/{}/config".format(intg, payload["uniq_id"])
-    logger.info("Add new device:  {}".format(topic))
-    mqtt.publish(topic, json.dumps(payload))
+    logger.info("Add new device:  %s", topic)
+    mqtt_publish(topic, json.dumps(payload))
 
 
 def mqtt_add_virtual():
@@ -677,7 +2076,7 @@ def mqtt_init_virtual():
             payload["~"] = payload["~"].format(prefix=prefix)
             topic = payload["~"] + "/state"
             logger.info("initial state:   {} = OFF".format(topic))
-            mqtt.publish(topic, "OFF")
+            mqtt_publish(topic, "OFF")
 
     # 인터폰 초기 상태 설정
     if Options["intercom_mode"] != "off":
@@ -688,16 +2087,16 @@ def mqtt_init_virtual():
             payload["~"] = payload["~"].format(prefix=prefix)
             topic = payload["~"] + "/state"
             logger.info("initial state:   {} = OFF".format(topic))
-            mqtt.publish(topic, "OFF")
+            mqtt_publish(topic, "OFF")
 
         # 초인종 울리기 전까지 문열림 스위치 offline으로 설정
         payload = "offline"
         topic = "{}/virtual/intercom/public/available".format(prefix)
-        logger.info("doorlock state:  {} = {}".format(topic, payload))
-        mqtt.publish(topic, payload)
+        logger.info("doorlock state:  %s = %s", topic, payload)
+        mqtt_publish(topic, payload)
         topic = "{}/virtual/intercom/private/available".format(prefix)
-        logger.info("doorlock state:  {} = {}".format(topic, payload))
-        mqtt.publish(topic, payload)
+        logger.info("doorlock state:  %s = %s", topic, payload)
+        mqtt_publish(topic, payload)
 
 
 def mqtt_virtual(topics, payload):
@@ -717,20 +2116,20 @@ def mqtt_virtual(topics, payload):
         return
 
     # 오류 체크 끝났으면 queue 에 넣어둠
-    virtual_trigger[device][(trigger, payload)] = time.time()
+    virtual_push(device, trigger, payload)
 
     # ON만 있는 명령은, 명령이 queue에 있는 동안 switch를 ON으로 표시
     prefix = Options["mqtt"]["prefix"]
     if "OFF" not in triggers[trigger]:
         topic = "{}/virtual/{}/{}/state".format(prefix, device, trigger)
-        logger.info("publish to HA:   {} = {}".format(topic, "ON"))
-        mqtt.publish(topic, "ON")
+        logger.info("publish to HA:   %s = %s", topic, "ON")
+        mqtt_publish(topic, "ON")
 
     # ON/OFF 있는 명령은, 마지막으로 받은 명령대로 표시
     else:
         topic = "{}/virtual/{}/{}/state".format(prefix, device, trigger)
-        logger.info("publish to HA:   {} = {}".format(topic, payload))
-        mqtt.publish(topic, payload)
+        logger.info("publish to HA:   %s = %s", topic, payload)
+        mqtt_publish(topic, payload)
 
     # 그동안 조용히 있었어도, 이젠 가로채서 응답해야 함
     if device == "entrance" and Options["entrance_mode"] == "minimal":
@@ -754,8 +2153,9 @@ def mqtt_debug(topics, payload):
             packet[-1] = serial_generate_checksum(packet)
             packet = bytes(packet)
 
+            # 패킷마다 따로 대기하지만, 지연시간 통계(key[-1])는 "packet" 하나로 모음 (topic, metrics label에 bytes가 들어가지 않도록)
             logger.info("prepare packet:  {}".format(packet.hex()))
-            serial_queue[packet] = time.time()
+            serial_queue.push(("debug", packet, "packet"), packet, COMMAND_PRIORITY_DEFAULT, Options["rs485"]["max_retry"])
             return
 
     logger.warning("    unknown debug topic: {}".format(topics))
@@ -787,45 +2187,133 @@ def mqtt_device(topics, payload):
         payload = payloads[payload]
 
     # 오류 체크 끝났으면 serial 메시지 생성
-    cmd = RS485_DEVICE[device][cmd]
+    key = (device, idn, cmd)
+    packet = codec_encode(device, cmd, idn, payload)
 
-    packet = bytearray(cmd["length"])
-    packet[0] = cmd["header"] >> 8
-    packet[1] = cmd["header"] & 0xFF
-
-    if "pos" in cmd: packet[cmd["pos"]] = int(float(payload))
-    if "id" in cmd: packet[cmd["id"]] = int(idn)
-
-    # parity 생성 후 queue 에 넣어둠
-    packet[-1] = serial_generate_checksum(packet)
-    packet = bytes(packet)
-
-    serial_queue[packet] = time.time()
+    # queue 에 넣어둠, 같은 장치의 같은 명령이 아직 대기중이면 새 값으로 대체됨
+    prio = RS485_DEVICE[device][cmd].get("prio", COMMAND_PRIORITY_DEFAULT)
+    serial_queue.push(key, packet, prio, Options["rs485"]["max_retry"])
 
 
 def mqtt_init_discovery():
     # HA가 재시작됐을 때 모든 discovery를 다시 수행한다
     Options["mqtt"]["_discovery"] = Options["mqtt"]["discovery"]
+    discovered_devices.clear()
+    discovery_seen.clear()
     mqtt_add_virtual()
 
     mqtt_init_state()
 
+    # 애드온 시작 후 첫 접속이면 cache 적용
+    if cache_pending:
+        cache_apply()
+
 
 def mqtt_init_state():
     for device in RS485_DEVICE:
         RS485_DEVICE[device]["last"] = {}
 
-    global last_topic_list
+    global last_topic_list, last_publish_time
     last_topic_list = {}
+    last_publish_time = {}
 
     mqtt_init_virtual()
 
 
+def cache_snapshot():
+    # 다른 스레드에서 바뀌는 중일 수 있으므로 dict는 복사해서 사용
+    devices = {}
+    for device in RS485_DEVICE:
+        ids = discovered_devices.get(device, {}).copy()
+        last = RS485_DEVICE[device]["last"].copy()
+
+        entry = {}
+        for idn in ids.keys() | last.keys():
+            packet = last.get(idn)
+            entry[str(idn)] = [ids.get(idn), packet.hex() if packet.__class__ is bytes else None]
+        if entry:
+            devices[device] = entry
+
+    return {
+        "version": CACHE_VERSION,
+        "prefix": Options["mqtt"]["prefix"],
+        "header_0_first": HEADER_0_FIRST,
+        "devices": devices,
+        "topics": last_topic_list.copy(),
+    }
+
+
+def cache_save():
+    # discovery 중에는 장치 목록이 완전하지 않으므로 저장하지 않음
+    if not Options["cache"].get("_enable") or Options["mqtt"]["_discovery"]:
+        return
+
+    global cache_saved
+    with cache_lock:
+        data = json.dumps(cache_snapshot(), separators=(",", ":"))
+        if data == cache_saved:
+            return
+
+        # SD 카드 수명과 전원 차단을 고려해서, 바뀌었을 때만 임시 파일에 쓰고 교체
+        filename = Options["cache"]["filename"]
+        temp = filename + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(temp, "w") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp, filename)
+            cache_saved = data
+        except OSError as e:
+            logger.warning("cache save failed: {} ({})".format(filename, e))
+
+
+def cache_loop():
+    while True:
+        cache_event.wait(Options["cache"]["interval"])
+        cache_event.clear()
+        cache_save()
+
+
+def cache_apply():
+    # 저장해둔 장치를 바로 등록하고 마지막 상태를 채워서, 첫 polling 주기부터 바뀐 값만 publish 되도록 한다
+    global cache_pending, warm_start
+    cache = cache_pending
+    cache_pending = None
+
+    count = 0
+    for device, ids in cache["devices"].items():
+        if device not in RS485_DEVICE:
+            continue
+
+        last = RS485_DEVICE[device]["last"]
+        for idn, (id2, packet) in ids.items():
+            idn = int(idn)
+            if Options["mqtt"]["discovery"]:
+                serial_new_device(device, idn, None, id2)
+            last[idn] = bytes.fromhex(packet) if packet else True
+            count += 1
+
+    # 애드온이 꺼져있는 동안 HA가 재시작됐을 수도 있으므로, 저장된 값은 한번 보내둔다
+    for topic, value in cache["topics"].items():
+        last_topic_list[topic] = value
+        mqtt_publish(topic, value)
+
+    warm_start = True
+    logger.info("warm start: {} devices, {} values from cache".format(count, len(cache["topics"])))
+
+
 def mqtt_on_message(mqtt, userdata, msg):
-    topics = msg.topic.split("/")
+    # 여러 bus 모드에서는 prefix가 sds/bus1 처럼 여러 단계이므로, prefix를 한 덩어리로 봄
+    prefix = Options["mqtt"]["prefix"]
+    if msg.topic.startswith(prefix + "/"):
+        topics = [prefix] + msg.topic[len(prefix) + 1:].split("/")
+    else:
+        topics = msg.topic.split("/")
     payload = msg.payload.decode()
 
-    logger.info("recv. from HA:   {} = {}".format(msg.topic, payload))
+    logger.info("recv. from HA:   %s = %s", msg.topic, payload)
 
     device = topics[1]
     if device == "status":
@@ -879,9 +2367,15 @@ def mqtt_on_disconnect(mqtt, userdata, rc):
 def start_mqtt_loop():
     logger.info("initialize mqtt...")
 
-    mqtt.on_message = mqtt_on_message
-    mqtt.on_connect = mqtt_on_connect
-    mqtt.on_disconnect = mqtt_on_disconnect
+    # 여러 bus 모드면 연결은 하나로 하고 bus별로 나눠줌
+    if buses:
+        mqtt.on_message = bus_on_message
+        mqtt.on_connect = bus_on_connect
+        mqtt.on_disconnect = bus_on_disconnect
+    else:
+        mqtt.on_message = mqtt_on_message
+        mqtt.on_connect = mqtt_on_connect
+        mqtt.on_disconnect = mqtt_on_disconnect
 
     if Options["mqtt"]["need_login"]:
         mqtt.username_pw_set(Options["mqtt"]["user"], Options["mqtt"]["passwd"])
@@ -893,6 +2387,12 @@ def start_mqtt_loop():
 
     mqtt.loop_start()
 
+    # publish 전용 스레드, 재접속해도 하나만 유지
+    global publish_worker
+    if publish_queue is not None and publish_worker is None:
+        publish_worker = threading.Thread(target=mqtt_publish_loop, daemon=True)
+        publish_worker.start()
+
     delay = 1
     while not mqtt_connected:
         logger.info("waiting MQTT connected ...")
@@ -900,6 +2400,20 @@ def start_mqtt_loop():
         delay = min(delay * 2, 10)
 
 
+def timer_loop():
+    while True:
+        time.sleep(TIMER_TICK)
+        timer_wheel.advance()
+
+
+def start_timer_loop():
+    # blocking 모드: 별도 스레드에서 tick, 재접속해도 하나만 유지
+    global timer_worker
+    if timer_wheel is not None and timer_worker is None:
+        timer_worker = threading.Thread(target=timer_loop, daemon=True)
+        timer_worker.start()
+
+
 def virtual_enable(header_0, header_1):
     prefix = Options["mqtt"]["prefix"]
 
@@ -907,40 +2421,64 @@ def virtual_enable(header_0, header_1):
     if header_1 == 0x32:
         payload = "online"
         topic = "{}/virtual/intercom/public/available".format(prefix)
-        logger.info("doorlock status: {} = {}".format(topic, payload))
-        mqtt.publish(topic, payload)
+        logger.info("doorlock status: %s = %s", topic, payload)
+        mqtt_publish(topic, payload)
 
     elif header_1 == 0x31:
         payload = "online"
         topic = "{}/virtual/intercom/private/available".format(prefix)
-        logger.info("doorlock status: {} = {}".format(topic, payload))
-        mqtt.publish(topic, payload)
+        logger.info("doorlock status: %s = %s", topic, payload)
+        mqtt_publish(topic, payload)
 
         VIRTUAL_DEVICE["intercom"]["trigger"]["private"] = VIRTUAL_DEVICE["intercom"]["trigger"]["priv_a"]
 
     elif header_1 == 0x36 or header_1 == 0x3E:
         payload = "offline"
         topic = "{}/virtual/intercom/public/available".format(prefix)
-        logger.info("doorlock status: {} = {}".format(topic, payload))
-        mqtt.publish(topic, payload)
+        logger.info("doorlock status: %s = %s", topic, payload)
+        mqtt_publish(topic, payload)
         topic = "{}/virtual/intercom/private/available".format(prefix)
-        logger.info("doorlock status: {} = {}".format(topic, payload))
-        mqtt.publish(topic, payload)
+        logger.info("doorlock status: %s = %s", topic, payload)
+        mqtt_publish(topic, payload)
         VIRTUAL_DEVICE["intercom"]["trigger"]["private"] = VIRTUAL_DEVICE["intercom"]["trigger"]["priv_b"]
 
 
+def virtual_push(device, trigger, cmd):
+    # 월패드가 받아줄 때까지 대기, max_retry가 지나면 버스 상황과 상관없이 지움
+    start = time.monotonic()
+    virtual_trigger[device][(trigger, cmd)] = start
+    if timer_wheel is not None:
+        timer_wheel.add(Options["rs485"]["max_retry"], virtual_expired.append, (device, trigger, cmd, start))
+
+
+def virtual_expire():
+    # timer가 넘겨준 만료 트리거를 serial 처리 중에 지움
+    while virtual_expired:
+        device, trigger, cmd, start = virtual_expired.popleft()
+
+        # 그 사이 성공했거나 같은 명령이 새로 들어왔으면 무시
+        if virtual_trigger[device].get((trigger, cmd)) != start:
+            continue
+
+        logger.error("send to wallpad: {}/{} {} max retry time exceeded!".format(device, trigger, cmd))
+        metrics["retry_exceeded_virtual"] += 1
+        virtual_pop(device, trigger, cmd)
+
+
 def virtual_pop(device, trigger, cmd):
     query = VIRTUAL_DEVICE[device]["default"]["query"]
     triggers = VIRTUAL_DEVICE[device]["trigger"]
 
     virtual_trigger[device].pop((trigger, cmd), None)
     virtual_ack.pop((VIRTUAL_DEVICE[device]["header0"] << 8) + triggers[trigger]["ack"], None)
+    serial_dispatch_update((VIRTUAL_DEVICE[device]["header0"] << 8) + triggers[trigger]["ack"])
+    virtual_sends.pop((device, trigger, cmd), None)
 
     # 명령이 queue에서 빠지면 OFF로 표시
     prefix = Options["mqtt"]["prefix"]
     topic = "{}/virtual/{}/{}/state".format(prefix, device, trigger)
-    logger.info("publish to HA:   {} = {}".format(topic, "OFF"))
-    mqtt.publish(topic, "OFF")
+    logger.info("publish to HA:   %s = %s", topic, "OFF")
+    mqtt_publish(topic, "OFF")
 
     # minimal 모드일 때, 조용해질지 여부
     if not virtual_trigger[device] and Options["entrance_mode"] == "minimal":
@@ -954,32 +2492,38 @@ def virtual_query(header_0, header_1):
     resp_size = VIRTUAL_DEVICE[device]["resp_size"]
 
     # pending이 남은 상태면 지금 시도해봐야 가망이 없음
-    if conn.check_pending_recv():
+    if framer.check_pending_recv():
         return
 
     # 아직 4~5Byte 중 2Byte만 받았으므로 다 올때까지 기다리는게 정석 같지만,
     # 조금 일찍 시작하는게 성공률이 더 높은거 같기도 하다.
     length = resp_size - 2 - int(Options["rs485"]["early_response"])
     if length > 0:
-        while conn.check_in_waiting() < length: pass
+        # 나머지가 제 시간에 안 들어오면 (깨진 패킷 등) 응답해봐야 충돌만 남
+        if not framer.wait_in_waiting(length, serial_byte_time() * (length + 2) + VIRTUAL_WAIT_MARGIN):
+            return
 
     if virtual_trigger[device] and header_1 == query:
         # 하나 뽑아서 보내봄
         trigger, cmd = next(iter(virtual_trigger[device]))
         resp = triggers[trigger][cmd].to_bytes(resp_size, "big")
         conn.send(resp)
+        virtual_sends[device, trigger, cmd] = virtual_sends.get((device, trigger, cmd), 0) + 1
 
-        # retry time 관리, 초과했으면 제거
-        elapsed = time.time() - virtual_trigger[device][trigger, cmd]
+        # retry time 관리, 초과했으면 제거 (timer가 먼저 지우지만, 응답을 보낸 김에 확인)
+        elapsed = time.monotonic() - virtual_trigger[device][trigger, cmd]
         if elapsed > Options["rs485"]["max_retry"]:
             logger.error("send to wallpad: {} max retry time exceeded!".format(resp.hex()))
+            metrics["retry_exceeded_virtual"] += 1
             virtual_pop(device, trigger, cmd)
-        elif elapsed > 3:
-            logger.warning("send to wallpad: {}, try another {:.01f} seconds...".format(resp.hex(), Options["rs485"]["max_retry"] - elapsed))
+        elif elapsed > RETRY_BACKOFF_AFTER:
+            logger.warning("send to wallpad: %s, try another %.01f seconds...", resp.hex(), Options["rs485"]["max_retry"] - elapsed)
             virtual_ack[(header_0 << 8) + triggers[trigger]["ack"]] = (device, trigger, cmd)
+            serial_dispatch_update((header_0 << 8) + triggers[trigger]["ack"])
         else:
-            logger.info("send to wallpad: {}".format(resp.hex()))
+            logger.info("send to wallpad: %s", resp.hex())
             virtual_ack[(header_0 << 8) + triggers[trigger]["ack"]] = (device, trigger, cmd)
+            serial_dispatch_update((header_0 << 8) + triggers[trigger]["ack"])
 
     # full 모드일 때, 일상 응답
     else:
@@ -990,7 +2534,7 @@ def virtual_query(header_0, header_1):
             # Byte[2] 가 wallpad를 따라가야 하는 경우
             if resp[2] == 0xFF:
                 ba = bytearray(resp)
-                ba[2] = conn.recv(1)[0]
+                ba[2] = framer.recv(1)[0]
                 ba[3] = serial_generate_checksum(ba)
                 resp = bytes(ba)
 
@@ -998,19 +2542,31 @@ def virtual_query(header_0, header_1):
 
 
 def virtual_clear(header):
-    logger.info("ack frm wallpad: {}".format(hex(header)))
+    logger.info("ack frm wallpad: %#x", header)
 
     device, trigger, cmd = virtual_ack[header]
     triggers = VIRTUAL_DEVICE[device]["trigger"]
 
+    # 트리거부터 ack까지 걸린 시간 기록
+    if (trigger, cmd) in virtual_trigger[device]:
+        elapsed = time.monotonic() - virtual_trigger[device][trigger, cmd]
+        latency_add("virtual", device, trigger, elapsed, virtual_sends.get((device, trigger, cmd), 1) - 1)
+
     # 성공한 명령을 지움
     virtual_pop(*virtual_ack[header])
     virtual_ack.pop(header, None)
+    serial_dispatch_update(header)
 
     # 다음 트리거로 이어지면 추가
     if triggers[trigger]["next"] != None:
-        next_trigger = triggers[trigger]["next"]
-        virtual_trigger[device][next_trigger] = time.time()
+        virtual_push(device, *triggers[trigger]["next"])
+
+
+def serial_byte_time():
+    # 1 Byte 전송 시간: start bit + data + parity + stop bit
+    ser = Options["serial"]
+    bits = 1 + ser["bytesize"] + (ser["parity"] != "N") + ser["stopbits"]
+    return bits / ser["baudrate"]
 
 
 def serial_verify_checksum(packet):
@@ -1075,12 +2631,141 @@ def serial_peek_value(parse, packet):
     return [(attr, value)]
 
 
-def serial_new_device(device, idn, packet):
+def codec_2byte(packet, pos):
+    return (packet[pos-1] << 8) + packet[pos]
+
+
+def codec_6decimal(packet, pos):
+    return packet[pos : pos+3].hex()
+
+
+def init_codec():
+    # serial_peek_value()의 형식별 동작을 Byte 값마다 미리 계산해서 table로 만들어 둠
+    STATE_DECODER.clear()
+    COMMAND_ENCODER.clear()
+    state_topics.clear()
+
+    for device, prop in RS485_DEVICE.items():
+        if "state" in prop:
+            decoder = []
+            for attr, pos, pattern in prop["state"]["parse"]:
+                if pattern == "2Byte":
+                    decoder.append((attr, pos, codec_2byte))
+                elif pattern == "6decimal":
+                    decoder.append((attr, pos, codec_6decimal))
+                else:
+                    # bitmap은 bit마다 attr이 하나씩 나옴
+                    values = [serial_peek_value((attr, 0, pattern), (v,)) for v in range(256)]
+                    for i, (name, _) in enumerate(values[0]):
+                        decoder.append((name, pos, tuple(value[i][1] for value in values)))
+            STATE_DECODER[device] = decoder
+
+        for cmd, form in prop.items():
+            if cmd in ("query", "state", "last"):
+                continue
+
+            template = bytearray(form["length"])
+            template[0] = form["header"] >> 8
+            template[1] = form["header"] & 0xFF
+            COMMAND_ENCODER[(device, cmd)] = (bytes(template), form.get("id"), form.get("pos"), template[0] ^ template[1])
+
+
+def codec_state_topics(device, idn):
+    # 장치 id마다 topic 문자열을 한번만 만들어 둠: (topic, pos, table, 로그 여부, publish 제한)
     prefix = Options["mqtt"]["prefix"]
+    topics = []
+    for attr, pos, table in STATE_DECODER[device]:
+        topic = "{}/{}/{:x}/{}/state".format(prefix, device, idn, attr)
+        policy = PUBLISH_POLICY.get("{}/{}".format(device, attr)) or PUBLISH_POLICY.get(device)
+        topics.append((topic, pos, table, attr != "current", policy))  # 전력사용량이나 현재온도는 너무 자주 바뀌어서 로그 제외
+
+    state_topics[(device, idn)] = topics
+    return topics
+
+
+def init_publish_policy():
+    PUBLISH_POLICY.clear()
+    for policy in Options["publish_policy"]:
+        target = policy["target"]
+        device = target.split("/")[0]
+        if device not in STATE_DECODER:
+            logger.warning("publish_policy: unknown device '{}'! ignored...".format(target))
+            continue
+
+        PUBLISH_POLICY[target] = (
+            policy.get("deadband") or 0,
+            policy.get("relative") or False,
+            policy.get("min_interval") or 0,
+            policy.get("heartbeat") or 0,
+        )
+        logger.info("publish_policy: {} = {}".format(target, PUBLISH_POLICY[target]))
+
+    state_topics.clear()
+
+
+def publish_policy_allow(topic, value, policy, now):
+    # 마지막 publish 이후 충분히 바뀌었거나, 충분히 오래 됐을 때만 허용
+    deadband, relative, min_interval, heartbeat = policy
+    last_time = last_publish_time.get(topic)
+    if last_time is None:
+        return True
+
+    elapsed = now - last_time
+    if heartbeat and elapsed >= heartbeat:
+        return True
+    if elapsed < min_interval:
+        return False
+
+    if deadband:
+        try:
+            old = float(last_topic_list[topic])
+            diff = abs(float(value) - old)
+        except (KeyError, TypeError, ValueError):
+            return True
+
+        if diff < (deadband * abs(old) / 100 if relative else deadband):
+            return False
+
+    return True
+
+
+def codec_encode(device, cmd, idn, payload):
+    # 틀을 복사해서 값만 채우고, checksum은 바뀐 Byte만 반영
+    template, id_pos, pos, checksum = COMMAND_ENCODER[(device, cmd)]
+    packet = bytearray(template)
+
+    if pos is not None:
+        # 대부분 정수로 오므로 float 변환은 필요할 때만
+        try:
+            value = int(payload)
+        except ValueError:
+            value = int(float(payload))
+        packet[pos] = value
+        checksum ^= value
+    if id_pos is not None:
+        value = int(idn)
+        checksum ^= packet[id_pos] ^ value
+        packet[id_pos] = value
+
+    packet[-1] = checksum & 0x7F
+    return bytes(packet)
+
+
+def serial_new_device(device, idn, packet, id2=None):
+    prefix = Options["mqtt"]["prefix"]
+
+    # cache에 없던 장치가 새로 나타났으면 다시 전체 상태를 등록해야 함
+    global warm_start
+    warm_start = False
+
+    discovered_devices.setdefault(device, {})[idn] = id2
+
+    # 응답 여부를 알 수 있는 장치는 availability topic도 등록
+    avail = Options["rs485"]["offline_miss"] and device in TRANSACTION_DEVICE
+    avail_topic = transaction_avail_topic(device, idn)
 
     # 조명은 두 id를 조합해서 개수와 번호를 정해야 함
     if device == "light":
-        id2 = last_query[3]
         num = idn >> 4
         try:
             idn = int("{:x}".format(idn))
@@ -1094,6 +2779,8 @@ def serial_new_device(device, idn, packet):
             payload["obj_id"] = payload["obj_id"].format(prefix=prefix, id2=id2+bit)
             payload["stat_t"] = payload["stat_t"].format(idn=idn, bit=bit+1)
             payload["cmd_t"] = payload["cmd_t"].format(id2=id2+bit)
+            if avail:
+                payload["avty_t"] = avail_topic
 
             mqtt_discovery(payload)
 
@@ -1116,10 +2803,51 @@ def serial_new_device(device, idn, packet):
                 if idn == 0:
                     payload["dev_cla"] = "power"
 
+            if avail:
+                payload["avty_t"] = avail_topic
+
             mqtt_discovery(payload)
 
+    # HA는 avty_t가 있으면 값을 받기 전까지 사용할 수 없음으로 표시하므로, 등록하자마자 현재 상태를 보냄
+    if avail:
+        stat = transaction_stat.get((device, idn))
+        mqtt_publish(avail_topic, "offline" if stat and not stat[3] else "online")
+
+
+def serial_query_id2(device, query):
+    # 조명은 query의 그룹 번호로 HA에 등록할 번호를 정함, 다른 장치는 None
+    pos = RS485_DEVICE[device]["query"].get("id2")
+    if pos is None or query is None:
+        return None
+    return query[pos]
 
-def serial_receive_state(device, packet):
+
+def serial_confirm_device(device, idn, packet, query):
+    # 직전 query에 대한 응답인지 (transaction_end에서 device, id 일치 확인됨), 전등은 query의 id2도 필요
+    # gas valve는 query부터 state로 읽으므로 확인할 필요 없음
+    id2 = None
+    if device in TRANSACTION_DEVICE:
+        if query is None:
+            return False
+
+        id2 = serial_query_id2(device, query)
+
+    # 같은 내용으로 정해진 횟수만큼 봐야 등록, bit가 튀어서 생긴 id는 다시 나오지 않으므로 걸러짐
+    key = (device, idn)
+    seen = discovery_seen.get(key)
+    if seen and seen[1] == id2:
+        seen[0] += 1
+    else:
+        seen = discovery_seen[key] = [1, id2]
+
+    if seen[0] < Options["mqtt"]["discovery_confirm"]:
+        return False
+
+    del discovery_seen[key]
+    return True
+
+
+def serial_receive_state(device, packet, query=None):
     form = RS485_DEVICE[device]["state"]
     last = RS485_DEVICE[device]["last"]
 
@@ -1128,199 +2856,890 @@ def serial_receive_state(device, packet):
     else:
         idn = 1
 
-    # 해당 ID의 이전 상태와 같은 경우 바로 무시
+    # 해당 ID의 이전 상태와 같은 경우 바로 무시 (packet은 수신 버퍼의 memoryview, 비교만 하면 복사 없음)
+    # heartbeat 시간이 된 값이 있으면 같은 패킷이어도 다시 publish
     if last.get(idn) == packet:
-        return
+        due = heartbeat_due.get((device, idn)) if heartbeat_due else None
+        if due is None or time.monotonic() < due:
+            return
 
-    # 처음 받은 상태인 경우, discovery 용도로 등록한다.
-    if Options["mqtt"]["_discovery"] and not last.get(idn):
-        # 전등 때문에 last query도 필요... 지금 패킷과 일치하는지 검증
-        # gas valve는 일치하지 않는다
-        if last_query[1] == packet[1] or device == "gas_valve":
-            serial_new_device(device, idn, packet)
+    # 아직 등록 안 한 장치인 경우, 충분히 확인되면 discovery 용도로 등록한다. (시작 후 언제든)
+    if Options["mqtt"]["discovery"] and idn not in discovered_devices.get(device, ()):
+        if serial_confirm_device(device, idn, packet, query):
+            serial_new_device(device, idn, packet, serial_query_id2(device, query))
             last[idn] = True
 
         # 장치 등록 먼저 하고, 상태 등록은 그 다음 턴에 한다. (난방 상태 등록 무시되는 현상 방지)
         return
 
-    else:
-        last[idn] = packet
-
-    # device 종류에 따라 전송할 데이터 정리
-    value_list = []
-    for parse in form["parse"]:
-        value_list += serial_peek_value(parse, packet)
+    last[idn] = bytes(packet)
 
-    # MQTT topic 형태로 변환, 이전 상태와 같은지 한번 더 확인해서 무시하거나 publish
-    for attr, value in value_list:
-        prefix = Options["mqtt"]["prefix"]
-        topic = "{}/{}/{:x}/{}/state".format(prefix, device, idn, attr)
-        if value == "" or last_topic_list.get(topic) == value: continue
+    # 미리 만들어 둔 topic, table로 값을 꺼내서, 이전 상태와 같은지 한번 더 확인해서 무시하거나 publish
+    topics = state_topics.get((device, idn)) or codec_state_topics(device, idn)
+    now = time.monotonic()
+    held = False
+    due = None
+    for topic, pos, table, log, policy in topics:
+        if table.__class__ is tuple:
+            value = table[packet[pos]]
+        else:
+            value = table(packet, pos)
+
+        if value == "":
+            metrics["suppress"] += 1
+            continue
+
+        if last_topic_list.get(topic) == value:
+            # 같은 값이어도 heartbeat 시간 동안 publish 안 했으면 다시 보냄 (cache 등으로 시각을 모르면 지금부터 셈)
+            heartbeat = policy[3] if policy else 0
+            if not heartbeat or now - last_publish_time.setdefault(topic, now) < heartbeat:
+                metrics["suppress"] += 1
+                if heartbeat:
+                    due = min(due or math.inf, last_publish_time[topic] + heartbeat)
+                continue
 
-        if attr != "current":  # 전력사용량이나 현재온도는 너무 자주 바뀌어서 로그 제외
-            logger.info("publish to HA:   {} = {} ({})".format(topic, value, packet.hex()))
-        mqtt.publish(topic, value)
+        # publish 제한에 걸리면 보류
+        elif policy and not publish_policy_allow(topic, value, policy, now):
+            metrics["hold"] += 1
+            held = True
+            continue
+
+        if policy:
+            last_publish_time[topic] = now
+            if policy[3]:
+                due = min(due or math.inf, now + policy[3])
+
+        if log:
+            logger.info("publish to HA:   %s = %s (%s)", topic, value, packet.hex())
+        mqtt_publish(topic, value)
+        metrics["publish"] += 1
         last_topic_list[topic] = value
 
+    # 보류한 값이 있으면, 같은 패킷이 계속 와도 다시 확인하도록 함 (min_interval, heartbeat 지나면 publish)
+    if held:
+        last[idn] = True
+    if due is not None:
+        heartbeat_due[device, idn] = due
+
 
 def serial_get_header():
-    try:
-        # 0x80보다 큰 byte가 나올 때까지 대기
-        while 1:
-            header_0 = conn.recv(1)[0]
-            if header_0 >= 0x80: break
+    # 첫 Byte만 0x80보다 큰 두 Byte를 찾음, 버퍼에서 한번에 검색
+    return framer.get_header()
 
-        # 중간에 corrupt되는 data가 있으므로 연속으로 0x80보다 큰 byte가 나오면 먼젓번은 무시한다
-        while 1:
-            header_1 = conn.recv(1)[0]
-            if header_1 < 0x80: break
-            header_0 = header_1
 
-    except (OSError, serial.SerialException):
-        logger.warning("ignore exception {}".format(e))
-        header_0 = header_1 = 0
+def serial_ack_command(packet):
+    cmd = serial_ack.pop(packet, None)
+    if cmd is None:
+        return
+    logger.info("ack from device: %s (%x)", cmd.hex(), packet)
 
-    # 헤더 반환
-    return header_0, header_1
+    # 성공한 명령을 지움
+    entry = serial_queue.pop(cmd)
 
+    if entry and entry.first_send:
+        latency_add("ack", entry.key[0], entry.key[-1], time.monotonic() - entry.first_send, entry.sends - 1)
 
-def serial_ack_command(packet):
-    logger.info("ack from device: {} ({:x})".format(serial_ack[packet].hex(), packet))
 
-    # 성공한 명령을 지움
-    serial_queue.pop(serial_ack[packet], None)
-    serial_ack.pop(packet)
+def serial_ack_header(cmd):
+    # 장치의 ack는 명령의 header_1, Byte[2]에 B0을 붙인 것
+    ack = bytearray(cmd[0:3])
+    ack[0] = 0xB0
+    return int.from_bytes(ack, "big")
+
+
+def serial_command_expire(entry):
+    # 대기열에서 이미 빠진 명령 (serial_command_expired 또는 serial_send_command에서 호출)
+    logger.error("send to device:  {} max retry time exceeded!".format(entry.packet.hex()))
+    metrics["retry_exceeded_device"] += 1
+
+    # 같은 ack를 기다리는 새 명령이 보내졌으면 그대로 둠
+    ack = serial_ack_header(entry.packet)
+    if serial_ack.get(ack) == entry.packet:
+        del serial_ack[ack]
+
+
+def serial_command_expired():
+    # timer가 대기열에서 지운 명령을 serial 처리 중에 정리
+    while serial_expired:
+        serial_command_expire(serial_expired.popleft())
 
 
 def serial_send_command():
-    # 한번에 여러개 보내면 응답이랑 꼬여서 망함
-    cmd = next(iter(serial_queue))
+    # 한번에 여러개 보내면 응답이랑 꼬여서 망함, 우선순위가 가장 높은 것 하나만
+    entry = serial_queue.peek()
+    if entry is None:
+        return
+    cmd = entry.packet
     conn.send(cmd)
 
-    ack = bytearray(cmd[0:3])
-    ack[0] = 0xB0
-    ack = int.from_bytes(ack, "big")
-
-    # retry time 관리, 초과했으면 제거
-    elapsed = time.time() - serial_queue[cmd]
-    if elapsed > Options["rs485"]["max_retry"]:
-        logger.error("send to device:  {} max retry time exceeded!".format(cmd.hex()))
-        serial_queue.pop(cmd)
-        serial_ack.pop(ack, None)
-    elif elapsed > 3:
-        logger.warning("send to device:  {}, try another {:.01f} seconds...".format(cmd.hex(), Options["rs485"]["max_retry"] - elapsed))
+    # 처음 보내는 거면 대기열에서 기다린 시간 기록
+    now = time.monotonic()
+    if not entry.sends:
+        entry.first_send = now
+        latency_add("queue", entry.key[0], entry.key[-1], now - entry.enqueue_time)
+    entry.sends += 1
+
+    # 이번 빈 시간은 직접 채웠으므로 주기 학습에서 제외
+    if bus_schedule_last:
+        bus_schedule_last[3] = True
+
+    ack = serial_ack_header(cmd)
+
+    # retry time 관리, 초과했으면 제거 (timer가 있으면 보통 먼저 지움)
+    if now > entry.deadline:
+        if serial_queue.pop(cmd):
+            serial_command_expire(entry)
+    elif now - entry.enqueue_time > RETRY_BACKOFF_AFTER:
+        logger.warning("send to device:  %s, try another %.01f seconds...", cmd.hex(), entry.deadline - now)
         serial_ack[ack] = cmd
+        entry.backoff = min(entry.backoff * 2 or RETRY_BACKOFF_MIN, RETRY_BACKOFF_MAX)
+        serial_queue.hold(entry, entry.backoff)
     else:
-        logger.info("send to device:  {}".format(cmd.hex()))
+        logger.info("send to device:  %s", cmd.hex())
         serial_ack[ack] = cmd
 
 
-def serial_loop():
-    logger.info("start loop ...")
+def transaction_avail_topic(device, idn):
+    # state topic과 같은 id 표기
+    return "{}/{}/{:x}/available".format(Options["mqtt"]["prefix"], device, idn)
+
+
+def transaction_begin(device, query, now):
+    global transaction_pending
+
+    # 이전 query에 응답이 없었음
+    if transaction_pending:
+        transaction_close(transaction_pending, None)
+
+    # checksum이 틀린 query는 어느 장치인지 모르므로 세지 않음
+    if not query:
+        transaction_pending = None
+        return
+
+    prop = RS485_DEVICE[device]["query"]
+    if "id" in prop:
+        idn = query[prop["id"]]
+    elif "id2" in prop:
+        # 전에 이 query에 응답했던 id, 아직 모르면 None (무응답도 세지 않음)
+        idn = transaction_room.get((device, query[prop["id2"]]))
+    else:
+        idn = 1
+    transaction_pending = (device, idn, now + len(query) * schedule_byte_time, bytes(query))
+
+
+def transaction_end(device, packet, now):
+    # 응답 대기 중인 query와 같은 장치, 같은 id면 짝을 맞추고 그 query를 돌려줌
+    global transaction_pending
+    pending = transaction_pending
+    if not pending or pending[0] != device:
+        return None
+
+    # query에 id가 없는 장치 (조명은 그룹 번호만 있음) 는 같은 장치의 다음 응답과 짝을 맞추고, 응답한 id로 셈
+    pos = RS485_DEVICE[device]["state"].get("id")
+    idn = packet[pos] if pos is not None else 1
+    if pending[1] != idn:
+        if "id" in RS485_DEVICE[device]["query"]:
+            return None
+
+        id2 = serial_query_id2(device, pending[3])
+        if id2 is not None:
+            transaction_room[device, id2] = idn
+        pending = (device, idn) + pending[2:]
+
+    transaction_pending = None
+    transaction_close(pending, now - pending[2])
+    return pending[3]
+
+
+def transaction_close(pending, seconds):
+    device, idn = pending[0], pending[1]
+    if idn is None:
+        return
+
+    # 월패드는 없는 id도 조회하므로, 한번이라도 응답한 id부터 무응답을 셈
+    key = (device, idn)
+    stat = transaction_stat.get(key)
+    if not stat:
+        if seconds is None:
+            return
+        stat = transaction_stat[key] = [0, 0, 0, True]
+
+    offline_miss = Options["rs485"]["offline_miss"]
+    if seconds is None:
+        stat[1] += 1
+        stat[2] += 1
+        if stat[3] and offline_miss and stat[2] >= offline_miss:
+            stat[3] = False
+            logger.warning("no reply from {} {:x} ({} times), set offline".format(device, idn, stat[2]))
+            if idn in discovered_devices.get(device, ()):
+                mqtt_publish(transaction_avail_topic(device, idn), "offline")
+        return
+
+    stat[0] += 1
+    stat[2] = 0
+    latency_add("reply", device, "{:x}".format(idn), max(seconds, 0.0))
+    if not stat[3]:
+        stat[3] = True
+        logger.info("{} {:x} replies again, set online".format(device, idn))
+        if idn in discovered_devices.get(device, ()):
+            mqtt_publish(transaction_avail_topic(device, idn), "online")
+
+
+def latency_add(span, device, cmd, seconds, retries=0):
+    key = (span, device, cmd)
+    if key not in latency_stat:
+        latency_stat[key] = SDSLatency()
+    latency_stat[key].add(seconds, retries)
+
+
+def latency_report():
+    # debug topic에 올리고, 로그에도 남김 (단위 ms)
+    prefix = Options["mqtt"]["prefix"]
+    for (span, device, cmd), stat in sorted(latency_stat.items()):
+        summary = stat.summary()
+        logger.info("latency {:7} {}/{}: {}".format(span, device, cmd, summary))
+
+        topic = "{}/debug/latency/{}/{}/{}".format(prefix, span, device, cmd)
+        mqtt_publish(topic, json.dumps(summary))
+
+    # 장치별 무응답 비율
+    for (device, idn), stat in sorted(transaction_stat.items()):
+        total = stat[0] + stat[1]
+        summary = {"n": total, "miss": stat[1], "miss_rate": round(stat[1] / total, 4) if total else 0, "online": stat[3]}
+        if stat[1]:
+            logger.info("reply   {}/{:x}: {}".format(device, idn, summary))
+
+        topic = "{}/debug/reply/{}/{:x}".format(prefix, device, idn)
+        mqtt_publish(topic, json.dumps(summary))
+
+
+def schedule_observe(header, size):
+    # 직전 패킷이 끝나고 지금 header가 나오기까지의 빈 시간을 직전 slot에 기록
+    global bus_schedule_last
+    now = time.monotonic()
+    last = bus_schedule_last
+    bus_schedule_last = [header, now, size, False]
+
+    # 그 사이 명령을 보냈거나, 밀린 데이터(패킷 하나 이상)를 처리하는 중이면 시각이 부정확하므로 무시
+    if not last or last[3] or len(framer) > SCHEDULE_BACKLOG:
+        return
+
+    gap = now - last[1] - last[2] * schedule_byte_time
+    slot = bus_schedule.get(last[0])
+    if not slot:
+        bus_schedule[last[0]] = [1, gap, 0.0, gap]
+        return
+
+    diff = gap - slot[1]
+    slot[0] += 1
+    slot[1] += diff * SCHEDULE_ALPHA
+    slot[2] = (1 - SCHEDULE_ALPHA) * (slot[2] + diff * diff * SCHEDULE_ALPHA)
+    slot[3] = gap
+
+
+def schedule_predict(header):
+    # 충분히 관찰된 slot만, 평균에서 표준편차 2배를 뺀 보수적인 예상치
+    slot = bus_schedule.get(header)
+    if not slot or slot[0] < SCHEDULE_WARMUP:
+        return 0
+    return slot[1] - 2 * math.sqrt(slot[2])
+
+
+def schedule_can_send(header):
+    # 명령과 장치의 응답이 들어갈 만큼 비어있고, 주기 중에서도 조용한 편인 slot인지 확인
+    gap = schedule_predict(header)
+    entry = serial_queue.peek()
+    if entry is None:
+        return False
+    need = 2 * len(entry.packet) * schedule_byte_time + SCHEDULE_GUARD
+    if gap < need:
+        return False
+
+    best = max(schedule_predict(h) for h in bus_schedule)
+    return gap >= best * SCHEDULE_QUIET_RATIO
+
+
+def schedule_publish():
+    # 튜닝용으로 slot별 예상/관측 시간을 debug topic에 올림 (ms)
+    payload = {
+        "{}:{:04X}".format(header >> 16, header & 0xFFFF): {
+            "n": slot[0],
+            "observed": round(slot[3] * 1000, 2),
+            "mean": round(slot[1] * 1000, 2),
+            "std": round(math.sqrt(slot[2]) * 1000, 2),
+            "predicted": round(schedule_predict(header) * 1000, 2),
+        }
+        for header, slot in bus_schedule.items()
+    }
+    topic = "{}/debug/schedule/state".format(Options["mqtt"]["prefix"])
+    mqtt_publish(topic, json.dumps(payload))
+
+
+def cycle_detect(headers, match):
+    # 자기상관: 주기만큼 밀었을 때 같은 header인 비율이 충분히 높은 가장 짧은 주기 (최소 두 주기는 있어야 함)
+    # 그 주기 안에 표시로 쓸 header_0가 없으면 (짧은 반복이 우연히 맞은 경우) 더 긴 주기를 찾아봄
+    n = len(headers)
+    for period in range(2, n // 2 + 1):
+        if match[period] < (n - period) * CYCLE_MATCH_RATIO:
+            continue
+
+        # 최근 주기들 안에서 주기마다 한번씩만 나오는 header_0 (장치 응답 제외)
+        cycles = n // period
+        recent = headers[-cycles * period:]
+        count = {}
+        for header, t, size in recent:
+            count[header >> 8] = count.get(header >> 8, 0) + 1
+        marks = [header_0 for header_0, c in count.items() if c == cycles and header_0 != HEADER_0_STATE]
+        if marks:
+            break
+    else:
+        return None
+
+    # 각 후보 바로 앞의 조용했던 시간 (직전 패킷 전송 시간 제외) 평균, 주기 사이에 쉬는 월패드는 여기서 구분됨
+    gap = {header_0: [] for header_0 in marks}
+    gaps = []
+    for (prev, t0, size), (header, t1, _) in zip(headers, headers[1:]):
+        idle = t1 - t0 - size * schedule_byte_time
+        gaps.append(idle)
+        if header >> 8 in gap:
+            gap[header >> 8].append(idle)
+    gaps.sort()
+    gap = {header_0: sum(idles) / len(idles) for header_0, idles in gap.items()}
+
+    # 다른 패킷 사이, 다른 후보보다 확실히 길어야 함
+    order = sorted(marks, key=gap.get, reverse=True)
+    best = gap[order[0]]
+    if best > gaps[len(gaps) // 2] + CYCLE_GAP_MIN and (len(order) == 1 or best > gap[order[1]] + CYCLE_GAP_MIN):
+        return period, order[0]
+
+    # 시간으로 구분이 안되면 (EW11이 모아서 보내는 경우 등) 기존 후보 순서대로
+    for header_0 in reversed(header_0_first_candidate):
+        if header_0 in gap:
+            return period, header_0
+    return period, min(marks)
+
+
+def cycle_clear():
+    cycle_headers.clear()
+    cycle_positions.clear()
+    cycle_match[:] = [0] * CYCLE_DETECT_MAX
+
+
+def cycle_observe(header, size):
+    global cycle_detecting, cycle_length, HEADER_0_FIRST, start_time, scan_count
+    n = len(cycle_headers)
+    cycle_headers.append((header, time.monotonic(), size))
+
+    # 앞에 나왔던 같은 header와의 거리마다 하나씩 (n이 CYCLE_DETECT_MAX 넘기 전에 끝나므로 범위 확인 불필요)
+    positions = cycle_positions.setdefault(header, [])
+    for pos in positions:
+        cycle_match[n - pos] += 1
+    positions.append(n)
+
+    n += 1
+    if n < CYCLE_DETECT_MIN or n % CYCLE_DETECT_STEP:
+        return
+
+    result = cycle_detect(cycle_headers, cycle_match)
+    if not result:
+        # 주기가 안 보이면 기존 방식에 맡김
+        if n >= CYCLE_DETECT_MAX:
+            logger.warning("polling cycle not found in {} headers".format(n))
+            cycle_detecting = False
+            cycle_clear()
+        return
+
+    cycle_length, header_0 = result
+    cycle_detecting = False
+    cycle_clear()
+
+    # 찾은 header로 다시 6초를 기다림 (안 그러면 기존 방식이 바로 다음 후보로 덮어쓸 수 있음)
+    start_time = time.monotonic()
+    scan_count = 0
+
+    logger.info("polling cycle: {} headers, starts with {:X}".format(cycle_length, header_0))
+    if header_0 != HEADER_0_FIRST:
+        # table은 HEADER_0_FIRST를 읽어서 만드므로, 바꾼 뒤에 이전 것과 새 것 둘 다 다시 만듦
+        old = HEADER_0_FIRST
+        HEADER_0_FIRST = header_0
+        serial_dispatch_update(old << 8, 0x100)
+        serial_dispatch_update(HEADER_0_FIRST << 8, 0x100)
+
+
+def serial_dispatch_entry(header):
+    header_0 = header >> 8
+    header_1 = header & 0xFF
+    flags = 0
+    info = None
+
+    if header in virtual_ack: flags |= DISPATCH_ACK
+    if header in virtual_avail: flags |= DISPATCH_AVAIL
+    if header_0 in header_0_virtual: flags |= DISPATCH_VIRTUAL
+
+    if header in STATE_HEADER:
+        flags |= DISPATCH_STATE
+        info = STATE_HEADER[header]
+    elif header_0 == HEADER_0_STATE:
+        flags |= DISPATCH_RESP
+    elif header in QUERY_HEADER:
+        flags |= DISPATCH_QUERY
+        info = QUERY_HEADER[header]
+
+    if header_1 == HEADER_1_SCAN: flags |= DISPATCH_SCAN
+    if header_0 == HEADER_0_FIRST: flags |= DISPATCH_FIRST
+
+    return (flags, info, serial_frame_need(header_0, header_1))
+
+
+def init_dispatch():
+    global serial_dispatch
+
+    # 대부분의 header는 같은 내용이므로 tuple을 공유
+    entries = {}
+    table = [None] * 0x10000
+    for header in range(0x10000):
+        entry = serial_dispatch_entry(header)
+        table[header] = entries.setdefault(entry, entry)
+
+    serial_dispatch = table
+
+
+def serial_dispatch_update(header, count=1):
+    for h in range(header, header + count):
+        serial_dispatch[h] = serial_dispatch_entry(h)
+
+
+def serial_loop_init():
+    global loop_count, scan_count, send_aggressive, start_time, schedule_byte_time, cycle_detecting, transaction_pending
     loop_count = 0
+    transaction_pending = None
+    cycle_detecting = True
+    cycle_clear()
     scan_count = 0
     send_aggressive = False
+    schedule_byte_time = serial_byte_time()
 
-    start_time = time.time()
-    while True:
-        # 로그 출력
-        sys.stdout.flush()
+    start_time = time.monotonic()
 
+
+def serial_loop():
+    logger.info("start loop ...")
+    serial_loop_init()
+
+    while True:
         # 첫 Byte만 0x80보다 큰 두 Byte를 찾음
         header_0, header_1 = serial_get_header()
-        header = (header_0 << 8) | header_1
+        serial_process(header_0, header_1)
+
+
+def serial_process(header_0, header_1):
+    global loop_count, scan_count, send_aggressive, start_time
+    header = (header_0 << 8) | header_1
+    flags, info, need = serial_dispatch[header]
+    send_schedule = Options["rs485"]["send_schedule"]
+
+    # 아직 한 주기도 못 셌으면 header 순서로 주기 시작을 찾음
+    if loop_count == 0 and cycle_detecting:
+        cycle_observe(header, need + 2)
+
+    # timer에서 만료된 가상 장치 트리거 정리
+    if virtual_expired:
+        virtual_expire()
+    if serial_expired:
+        serial_command_expired()
+
+    # 이번 header 직전까지 얼마나 조용했는지 학습
+    slot = None
+    if send_schedule:
+        global bus_schedule_pos
+        if flags & DISPATCH_FIRST:
+            bus_schedule_pos = 0
+        elif bus_schedule_pos is not None:
+            bus_schedule_pos += 1
+
+        if bus_schedule_pos is not None:
+            slot = (bus_schedule_pos << 16) | header
+            schedule_observe(slot, need + 2)
+
+    # 요청했던 동작의 ack 왔는지 확인
+    if flags & DISPATCH_ACK:
+        virtual_clear(header)
+
+    # 인터폰 availability 관련 헤더인지 확인
+    if flags & DISPATCH_AVAIL:
+        virtual_enable(header_0, header_1)
+
+    # 가상 장치로써 응답해야 할 header인지 확인
+    if flags & DISPATCH_VIRTUAL:
+        virtual_query(header_0, header_1)
+
+    # device로부터의 state 응답이면 확인해서 필요시 HA로 전송해야 함
+    if flags & DISPATCH_STATE:
+        # 몇 Byte짜리 패킷인지 확인
+        device, remain = info
+
+        # 해당 길이만큼 읽음, checksum 오류가 있으면 무시 (응답 대기 중인 query는 다음 query 때 무응답 처리)
+        now = time.monotonic()
+        packet = framer.recv_frame(remain)
+        if not packet:
+            return
+        metrics_frames[device] = metrics_frames.get(device, 0) + 1
+        query = transaction_end(device, packet, now) if transaction_pending else None
+
+        # 디바이스 응답 뒤에도 명령 보내봄 (학습한 주기대로 보내는 경우 제외)
+        if serial_queue and not send_schedule and not framer.check_pending_recv():
+            serial_send_command()
+            framer.set_pending_recv()
+
+        # 적절히 처리한다
+        serial_receive_state(device, packet, query)
+
+    elif flags & DISPATCH_RESP:
+        # 한 byte 더 뽑아서, 보냈던 명령의 ack인지 확인
+        header_2 = framer.recv(1)[0]
+        header = (header << 8) | header_2
+
+        if header in serial_ack:
+            serial_ack_command(header)
+
+    # 장치 응답과 짝을 맞추기 위해 query를 기록해둔다 (응답 여부, 응답 시간, 조명 discovery에 필요)
+    elif flags & DISPATCH_QUERY:
+        # 나머지 더 뽑아서 저장, checksum이 틀리면 버림
+        now = time.monotonic()
+        packet = framer.recv_frame(info[1])
+        transaction_begin(info[0], packet, now)
+
+    # 명령을 보낼 타이밍인지 확인: 0xXX5A 는 장치가 있는지 찾는 동작이므로,
+    # 아직도 이러고 있다는건 아무도 응답을 안할걸로 예상, 그 타이밍에 끼어든다.
+    if flags & DISPATCH_SCAN or send_aggressive:
+        scan_count += 1
+        if serial_queue and not framer.check_pending_recv():
+            serial_send_command()
+            framer.set_pending_recv()
+
+    # 학습한 주기에서 이 패킷 뒤가 충분히 조용할 것으로 예상되면 그 때 보냄
+    elif send_schedule and serial_queue and not framer.check_pending_recv() and schedule_can_send(slot):
+        serial_send_command()
+        framer.set_pending_recv()
+
+    # 전체 루프 수 카운트
+    global HEADER_0_FIRST
+    if flags & DISPATCH_FIRST:
+        loop_count += 1
+
+        if reconnect_lost_time:
+            conn_resumed()
+
+        if send_schedule and loop_count % SCHEDULE_PUBLISH_LOOPS == 0:
+            schedule_publish()
+
+        # 명령 지연시간 통계는 가끔씩만
+        global latency_report_time
+        if latency_stat and time.monotonic() - latency_report_time > LATENCY_REPORT_INTERVAL:
+            latency_report_time = time.monotonic()
+            latency_report()
+
+        # 돌만큼 돌았으면 상황 판단
+        if loop_count == 30:
+            # 처음 장치 찾기 구간 끝 (새 장치는 serial_confirm_device로 이후에도 계속 등록됨)
+            if Options["mqtt"]["_discovery"]:
+                logger.info("Add new device:  All done.")
+                Options["mqtt"]["_discovery"] = False
+
+                # discovery 속도 문제로 HA에 초기 상태 등록 안되는 경우 있어서, 한번 재등록
+                # cache로 시작했고 새 장치가 없으면 이미 등록돼 있으므로 생략
+                global warm_start
+                if warm_start:
+                    logger.info("warm start: no new device, keep current state")
+                    warm_start = False
+                else:
+                    mqtt_init_state()
 
-        # 요청했던 동작의 ack 왔는지 확인
-        if header in virtual_ack:
-            virtual_clear(header)
+                # 장치 목록이 완성됐으니 바로 저장
+                cache_event.set()
 
-        # 인터폰 availability 관련 헤더인지 확인
-        if header in virtual_avail:
-            virtual_enable(header_0, header_1)
+            else:
+                logger.info("running stable...")
+
+            # 스캔이 없거나 적으면, 명령을 내릴 타이밍을 못잡는걸로 판단, 아무때나 닥치는대로 보내봐야한다.
+            if Options["serial_mode"] == "serial" and scan_count < 30 and not send_schedule:
+                logger.warning("initiate aggressive send mode! (scan count: %d)", scan_count)
+                send_aggressive = True
+
+        # HA 재시작한 경우
+        elif loop_count > 30 and Options["mqtt"]["_discovery"]:
+            loop_count = 1
+
+    # 루프 카운트 세는데 실패하면 다른 걸로 시도해봄
+    if loop_count == 0 and time.monotonic() - start_time > 6:
+        logger.warning("check loop count fail: there are no {:X}! try {:X}...".format(HEADER_0_FIRST, header_0_first_candidate[-1]))
+        # table은 HEADER_0_FIRST를 읽어서 만드므로, 바꾼 뒤에 이전 것과 새 것 둘 다 다시 만듦
+        old = HEADER_0_FIRST
+        HEADER_0_FIRST = header_0_first_candidate.pop()
+        serial_dispatch_update(old << 8, 0x100)
+        serial_dispatch_update(HEADER_0_FIRST << 8, 0x100)
+        start_time = time.monotonic()
+        scan_count = 0
+
+
+def serial_frame_need(header_0, header_1):
+    # serial_process가 header 뒤로 더 읽어야 하는 byte 수, asyncio 모드에서는 다 도착한 뒤에 처리해야 막히지 않음
+    header = (header_0 << 8) | header_1
+    need = 0
+
+    if header_0 in header_0_virtual:
+        device = header_0_virtual[header_0]
+        need = max(VIRTUAL_DEVICE[device]["resp_size"] - 2 - int(Options["rs485"]["early_response"]), 1)
+
+    if header in STATE_HEADER:
+        need = max(need, STATE_HEADER[header][1])
+    elif header_0 == HEADER_0_STATE:
+        need = max(need, 1)
+    elif header in QUERY_HEADER:
+        need = max(need, QUERY_HEADER[header][1])
+
+    return need
+
+
+def serial_on_readable(lost):
+    # asyncio 모드: 읽을 수 있을 때 불려서, 완성된 패킷들을 모두 처리
+    try:
+        framer.fill_nowait()
+    except RuntimeError as e:
+        if not lost.done():
+            lost.set_exception(e)
+        return
 
-        # 가상 장치로써 응답해야 할 header인지 확인
-        if header_0 in header_0_virtual:
-            virtual_query(header_0, header_1)
+    try:
+        while True:
+            mark = framer.mark()
+            header = framer.get_header_nowait()
+            if not header:
+                break
 
-        # device로부터의 state 응답이면 확인해서 필요시 HA로 전송해야 함
-        if header in STATE_HEADER:
-            packet = bytes([header_0, header_1])
+            if len(framer) < serial_dispatch[(header[0] << 8) | header[1]][2]:
+                framer.rewind(mark)
+                break
 
-            # 몇 Byte짜리 패킷인지 확인
-            device, remain = STATE_HEADER[header]
+            serial_process(*header)
 
-            # 해당 길이만큼 읽음
-            packet += conn.recv(remain)
+    # 여기서 난 예외는 event loop가 삼켜버리므로, blocking 모드처럼 밖으로 던져준다
+    except Exception as e:
+        if not lost.done():
+            lost.set_exception(e)
 
-            # checksum 오류 없는지 확인
-            if not serial_verify_checksum(packet):
-                continue
 
-            # 디바이스 응답 뒤에도 명령 보내봄
-            if serial_queue and not conn.check_pending_recv():
-                serial_send_command()
-                conn.set_pending_recv()
-
-            # 적절히 처리한다
-            serial_receive_state(device, packet)
-
-        elif header_0 == HEADER_0_STATE:
-            # 한 byte 더 뽑아서, 보냈던 명령의 ack인지 확인
-            header_2 = conn.recv(1)[0]
-            header = (header << 8) | header_2
-
-            if header in serial_ack:
-                serial_ack_command(header)
-
-        # 마지막으로 받은 query를 저장해둔다 (조명 discovery에 필요)
-        elif header in QUERY_HEADER:
-            # 나머지 더 뽑아서 저장
-            global last_query
-            packet = conn.recv(QUERY_HEADER[header][1])
-            packet = header.to_bytes(2, "big") + packet
-            last_query = packet
-
-        # 명령을 보낼 타이밍인지 확인: 0xXX5A 는 장치가 있는지 찾는 동작이므로,
-        # 아직도 이러고 있다는건 아무도 응답을 안할걸로 예상, 그 타이밍에 끼어든다.
-        if header_1 == HEADER_1_SCAN or send_aggressive:
-            scan_count += 1
-            if serial_queue and not conn.check_pending_recv():
-                serial_send_command()
-                conn.set_pending_recv()
-
-        # 전체 루프 수 카운트
-        global HEADER_0_FIRST
-        if header_0 == HEADER_0_FIRST:
-            loop_count += 1
-
-            # 돌만큼 돌았으면 상황 판단
-            if loop_count == 30:
-                # discovery: 가끔 비트가 튈때 이상한 장치가 등록되는걸 막기 위해, 시간제한을 둠
-                if Options["mqtt"]["_discovery"]:
-                    logger.info("Add new device:  All done.")
-                    Options["mqtt"]["_discovery"] = False
-
-                    # discovery 속도 문제로 HA에 초기 상태 등록 안되는 경우 있어서, 한번 재등록
-                    mqtt_init_state()
+async def mqtt_async_misc():
+    # paho의 loop_start 대신, keepalive와 재접속을 event loop에서 처리
+    while True:
+        await asyncio.sleep(1)
+        if mqtt.loop_misc() == paho_mqtt.MQTT_ERR_NO_CONN:
+            try:
+                mqtt.reconnect()
+            except Exception as e:
+                logger.warning("MQTT reconnect failed! ({})".format(e))
 
-                else:
-                    logger.info("running stable...")
 
-                # 스캔이 없거나 적으면, 명령을 내릴 타이밍을 못잡는걸로 판단, 아무때나 닥치는대로 보내봐야한다.
-                if Options["serial_mode"] == "serial" and scan_count < 30:
-                    logger.warning("initiate aggressive send mode!", scan_count)
-                    send_aggressive = True
+async def timer_async():
+    # asyncio 모드: serial 처리와 같은 event loop에서 tick 하므로 경합 없음
+    while True:
+        await asyncio.sleep(TIMER_TICK)
+        timer_wheel.advance()
+
+
+async def start_mqtt_async(loop):
+    logger.info("initialize mqtt (asyncio)...")
+
+    mqtt.on_message = mqtt_on_message
+    mqtt.on_connect = mqtt_on_connect
+    mqtt.on_disconnect = mqtt_on_disconnect
+
+    # MQTT 소켓도 같은 event loop에서 읽고 쓴다
+    mqtt.on_socket_open = lambda client, userdata, sock: loop.add_reader(sock, client.loop_read)
+    mqtt.on_socket_close = lambda client, userdata, sock: loop.remove_reader(sock)
+    mqtt.on_socket_register_write = lambda client, userdata, sock: loop.add_writer(sock, client.loop_write)
+    mqtt.on_socket_unregister_write = lambda client, userdata, sock: loop.remove_writer(sock)
+
+    # publish 대기열은 지금 처리 중인 패킷이 끝난 뒤 event loop에서 비운다
+    if publish_queue is not None:
+        publish_queue.notify = lambda: loop.call_soon_threadsafe(mqtt_publish_drain)
+
+    if Options["mqtt"]["need_login"]:
+        mqtt.username_pw_set(Options["mqtt"]["user"], Options["mqtt"]["passwd"])
+
+    try:
+        mqtt.connect(Options["mqtt"]["server"], Options["mqtt"]["port"])
+    except Exception as e:
+        raise AssertionError("MQTT server address/port may be incorrect! ({})".format(str(e)))
+
+    loop.create_task(mqtt_async_misc())
+
+    delay = 1
+    while not mqtt_connected:
+        logger.info("waiting MQTT connected ...")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 10)
+
 
-            # HA 재시작한 경우
-            elif loop_count > 30 and Options["mqtt"]["_discovery"]:
-                loop_count = 1
+async def async_loop():
+    # 버스, MQTT가 모두 한 event loop에서 돌기 때문에 스레드 간 경합이 없음
+    loop = asyncio.get_running_loop()
+    lost = loop.create_future()
 
-        # 루프 카운트 세는데 실패하면 다른 걸로 시도해봄
-        if loop_count == 0 and time.time() - start_time > 6:
-            logger.warning("check loop count fail: there are no {:X}! try {:X}...".format(HEADER_0_FIRST, header_0_first_candidate[-1]))
-            HEADER_0_FIRST = header_0_first_candidate.pop()
-            start_time = time.time()
-            scan_count = 0
+    await start_mqtt_async(loop)
+
+    logger.info("start loop (asyncio) ...")
+    serial_loop_init()
+    if timer_wheel is not None:
+        loop.create_task(timer_async())
+
+    while True:
+        fd = conn.fileno()
+        loop.add_reader(fd, serial_on_readable, lost)
+        try:
+            await lost
+        except RuntimeError as e:
+            error = e
+        finally:
+            loop.remove_reader(fd)
+
+        # 연결이 끊기면 다시 연결, 여는 동안에도 MQTT는 계속 처리되도록 별도 스레드에서 시도
+        conn_lost(error)
+        attempt = 0
+        while not await loop.run_in_executor(None, conn_reopen):
+            await asyncio.sleep(conn_reconnect_delay(attempt))
+            attempt += 1
+
+        lost = loop.create_future()
+        serial_loop_init()
+
+
+def metrics_collect(add):
+    add("loop_count", "gauge", "polling cycles counted since discovery started", [(None, loop_count)])
+    add("cycle_headers", "gauge", "polling cycle length in headers, 0 if the default cycle start was found", [(None, cycle_length)])
+    add("scan_count", "gauge", "device scan (XX5A) headers seen", [(None, scan_count)])
+    add("send_aggressive", "gauge", "1 if aggressive send mode is active", [(None, int(send_aggressive))])
+    add("reconnect_total", "counter", "RS485 transport reconnects", [(None, metrics["reconnect"])])
+    add("reconnect_seconds", "gauge", "time from the last connection loss until polling resumed", [(None, metrics["reconnect_seconds"])])
+    add("reconnect_seconds_total", "counter", "total time without RS485 connection", [(None, metrics["reconnect_seconds_total"])])
+
+    if framer is not None:
+        add("bytes_total", "counter", "bytes received from the RS485 bus", [(None, framer.bytes_total)])
+        add("checksum_fail_total", "counter", "packets dropped by checksum", [(None, framer.checksum_fail)])
+
+    if failover is not None:
+        links = failover.links
+        add("link_active", "gauge", "1 for the link packets are read from (serial_mode: failover)", [({"link": link.mode}, int(link is failover.active)) for link in links])
+        add("link_up", "gauge", "1 if the link is open", [({"link": link.mode}, int(link.conn is not None)) for link in links])
+        add("link_bytes_total", "counter", "bytes received per link", [({"link": link.mode}, link.bytes_total) for link in links])
+        add("link_frames_total", "counter", "packets that passed checksum per link", [({"link": link.mode}, link.frames_total) for link in links])
+        add("link_checksum_fail_total", "counter", "packets dropped by checksum per link", [({"link": link.mode}, link.checksum_fail) for link in links])
+        add("link_switch_total", "counter", "failover switches between links", [(None, failover.switch_total)])
+
+    add("frames_total", "counter", "valid state packets per device",
+        [({"device": device}, count) for device, count in list(metrics_frames.items())])
+    add("mqtt_publish_total", "counter", "state publishes to MQTT", [(None, metrics["publish"])])
+    add("mqtt_suppress_total", "counter", "state publishes skipped because the value did not change", [(None, metrics["suppress"])])
+    add("mqtt_hold_total", "counter", "state publishes held back by publish_policy", [(None, metrics["hold"])])
+    if publish_queue is not None:
+        add("mqtt_queue_depth", "gauge", "publishes waiting for the MQTT worker", [(None, len(publish_queue))])
+        add("mqtt_coalesced_total", "counter", "queued publishes replaced by a newer value for the same topic", [(None, publish_queue.coalesced)])
+        add("mqtt_dropped_total", "counter", "publishes dropped because the queue was full", [(None, publish_queue.dropped)])
+
+    samples = []
+    for (device, idn), stat in list(transaction_stat.items()):
+        samples.append(({"device": device, "id": "{:x}".format(idn), "result": "ok"}, stat[0]))
+        samples.append(({"device": device, "id": "{:x}".format(idn), "result": "miss"}, stat[1]))
+    add("device_reply_total", "counter", "wallpad queries answered or missed per device", samples)
+    add("device_online", "gauge", "0 if the device missed offline_miss queries in a row",
+        [({"device": device, "id": "{:x}".format(idn)}, int(stat[3])) for (device, idn), stat in list(transaction_stat.items())])
+
+    if gateway is not None:
+        add("gateway_clients", "gauge", "TCP clients receiving the raw RS485 stream", [(None, gateway.clients)])
+        add("gateway_dropped_total", "counter", "gateway clients dropped because they fell behind", [(None, gateway.dropped)])
+
+    add("command_queue_depth", "gauge", "commands waiting to be sent to devices", [(None, len(serial_queue) if serial_queue is not None else 0)])
+    if timer_wheel is not None:
+        add("timers", "gauge", "pending retry and trigger timers", [(None, len(timer_wheel))])
+    add("virtual_queue_depth", "gauge", "virtual device triggers waiting for the wallpad",
+        [({"device": device}, len(triggers)) for device, triggers in list(virtual_trigger.items())])
+    add("retry_exceeded_total", "counter", "commands dropped after max_retry",
+        [({"kind": "device"}, metrics["retry_exceeded_device"]), ({"kind": "virtual"}, metrics["retry_exceeded_virtual"])])
+
+    samples = []
+    for (span, device, cmd), stat in list(latency_stat.items()):
+        labels = {"span": span, "device": device, "command": cmd}
+        for q in (0.5, 0.95, 0.99):
+            samples.append((dict(labels, quantile=q), stat.percentile(q)))
+        samples.append((dict(labels, suffix="_sum"), stat.total))
+        samples.append((dict(labels, suffix="_count"), stat.n))
+    add("command_latency_seconds", "summary", "command latency (queue, ack, virtual)", samples)
+
+
+def metrics_label(value):
+    # Prometheus text format의 label 값은 \, ", 줄바꿈을 escape 해야 함 (안 하면 scrape 전체가 실패)
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def metrics_render():
+    # Prometheus text format, 여러 bus 모드면 같은 이름끼리 모으고 bus label을 붙임
+    families = {}
+
+    def collector(bus):
+        def add(name, kind, help, samples):
+            family = families.setdefault(name, (kind, help, []))[2]
+            for labels, value in samples:
+                if bus:
+                    labels = dict(labels or {}, bus=bus)
+                family.append((labels, value))
+        return add
+
+    if buses:
+        for name, module in buses.items():
+            module.metrics_collect(collector(name))
+    else:
+        metrics_collect(collector(None))
+
+    lines = []
+    for name, (kind, help, samples) in families.items():
+        lines.append("# HELP sds_wallpad_{} {}".format(name, help))
+        lines.append("# TYPE sds_wallpad_{} {}".format(name, kind))
+        for labels, value in samples:
+            suffix = ""
+            if labels:
+                suffix = labels.pop("suffix", "")
+                labels = "{" + ",".join('{}="{}"'.format(k, metrics_label(v)) for k, v in labels.items()) + "}"
+            lines.append("sds_wallpad_{}{}{} {}".format(name, suffix, labels or "", value))
+
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+
+        body = metrics_render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # 요청마다 로그 남기지 않음
+        pass
+
+
+def start_metrics_server():
+    if not Options["metrics"]["enable"]:
+        return
+
+    port = Options["metrics"]["port"]
+    logger.info("start metrics endpoint at :{}/metrics".format(port))
+    server = http.server.ThreadingHTTPServer(("", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
 
 
 def dump_loop():
@@ -1336,14 +3755,16 @@ def dump_loop():
 
         conn.set_timeout(2)
         logs = []
+        buf = bytearray(256)
+        view = memoryview(buf)
         while time.time() - start_time < dump_time:
             try:
-                data = conn.recv(256)
+                n = conn.recv_into(view)
             except:
                 continue
 
-            if data:
-                for b in data:
+            if n:
+                for b in buf[:n]:
                     if b == 0xA1 or len(logs) > 500:
                         logger.info("".join(logs))
                         logs = ["{:02X}".format(b)]
@@ -1388,23 +3809,272 @@ def send_discord_message_with_curl(webhook_url, message):
     except Exception as e:
         logger.warning(f"Unexpected error while sending message via curl: {e}")
 
-def conn_init():
-    global conn
-
-    if Options["serial_mode"] == "socket":
+def conn_open():
+    global failover
+    if Options["serial_mode"] == "failover":
+        logger.info("initialize serial and socket (failover)...")
+        failover = SDSFailover()
+        return failover
+    elif Options["serial_mode"] == "socket":
         logger.info("initialize socket...")
-        conn = SDSSocket()
+        return SDSSocket()
+    elif Options["serial_mode"] == "replay":
+        logger.info("initialize replay...")
+        return SDSReplay()
     else:
         logger.info("initialize serial...")
-        conn = SDSSerial()
+        return SDSSerial()
+
+
+def conn_init():
+    global conn, framer
+
+    conn = conn_open()
+    if Options["serial_mode"] in ("replay", "failover") and Options["loop_mode"] == "asyncio":
+        logger.warning("{} works with blocking loop_mode only! automatically changed...".format(Options["serial_mode"]))
+        Options["loop_mode"] = "blocking"
+
+    conn = conn_wrap(conn)
+    framer = SDSFramer(conn)
+
+
+def conn_wrap(new_conn):
+    # capture 기록과 gateway는 재접속해도 그대로 두고, 안쪽 연결만 바꿈
+    global recorder, gateway
+    if Options["capture"]["record"] and Options["serial_mode"] != "replay":
+        if recorder is None:
+            logger.info("record to {}".format(Options["capture"]["filename"]))
+            recorder = SDSRecorder(new_conn, Options["capture"]["filename"])
+        else:
+            recorder.attach(new_conn)
+        new_conn = recorder
+
+    if Options["gateway"]["enable"] and gateway is None:
+        port = Options["gateway"]["port"]
+        try:
+            gateway = SDSGateway(port, Options["gateway"]["writable"])
+            logger.info("serve RS485 stream at :{}{}".format(port, " (writable)" if Options["gateway"]["writable"] else ""))
+        except OSError as e:
+            # gateway는 부가 기능이므로 애드온은 계속 동작, 재접속 때 다시 시도하지 않음
+            logger.warning("gateway disabled: cannot listen on :{} ({})".format(port, e))
+            Options["gateway"]["enable"] = False
+
+    if gateway is not None:
+        gateway.attach(new_conn)
+        new_conn = gateway
+
+    return new_conn
+
+
+def conn_lost(error):
+    global reconnect_lost_time, bus_schedule_last, bus_schedule_pos
+    logger.warning("connection lost: {} - reconnecting...".format(error))
+    reconnect_lost_time = time.monotonic()
+
+    # 끊긴 동안의 빈 시간은 주기 학습에서 제외, 다시 주기 시작을 볼 때까지 순서도 모름
+    bus_schedule_last = None
+    bus_schedule_pos = None
+
+    try:
+        conn.close()
+    except Exception as e:
+        logger.warning("close failed! ({})".format(e))
+
+
+def conn_reopen():
+    # 한번 시도, 성공하면 기존 recorder, gateway와 framer에 새 연결을 붙임
+    global conn
+    try:
+        new_conn = conn_open()
+    except (RuntimeError, OSError) as e:
+        logger.warning("reconnect failed: {}".format(e))
+        if time.monotonic() - reconnect_lost_time > RECONNECT_GIVE_UP:
+            raise RuntimeError("reconnect failed for {} seconds! ({})".format(RECONNECT_GIVE_UP, e))
+        return False
+
+    conn = conn_wrap(new_conn)
+    framer.attach(conn)
+
+    logger.info("reconnected after {:.1f} seconds".format(time.monotonic() - reconnect_lost_time))
+    return True
+
+
+def conn_reconnect_delay(attempt):
+    # 여러 번 실패하면 점점 길게, 같은 타이밍에 몰리지 않도록 jitter
+    delay = min(RECONNECT_DELAY_MAX, RECONNECT_DELAY_MIN * 2 ** attempt)
+    return delay * random.uniform(0.5, 1.0)
+
+
+def conn_reconnect(error):
+    conn_lost(error)
+
+    attempt = 0
+    while not conn_reopen():
+        time.sleep(conn_reconnect_delay(attempt))
+        attempt += 1
+
+
+def conn_resumed():
+    # 재접속 후 첫 polling 주기를 셀 때까지를 복구 시간으로 봄
+    global reconnect_lost_time
+    seconds = time.monotonic() - reconnect_lost_time
+    reconnect_lost_time = None
+
+    metrics["reconnect"] += 1
+    metrics["reconnect_seconds"] = seconds
+    metrics["reconnect_seconds_total"] += seconds
+    logger.info("bus resumed {:.1f} seconds after connection lost".format(seconds))
+
+
+def bus_filename(filename, name):
+    # /share/sds_wallpad.cache -> /share/sds_wallpad.bus1.cache
+    root, ext = os.path.splitext(filename)
+    return "{}.{}{}".format(root, name, ext)
+
+
+def bus_options(entry, index):
+    # 전체 설정을 기본값으로, bus마다 연결과 prefix, 파일 이름만 바꿈
+    name = entry["name"]
+    options = copy.deepcopy(Options)
+    options["buses"] = []
+    options["loop_mode"] = "blocking"
+    options["serial_mode"] = entry["serial_mode"]
+
+    if entry.get("serial_port"):
+        options["serial"]["port"] = entry["serial_port"]
+    if entry.get("socket_address"):
+        options["socket"]["address"] = entry["socket_address"]
+    if entry.get("socket_port"):
+        options["socket"]["port"] = entry["socket_port"]
+
+    options["mqtt"]["prefix"] = "{}/{}".format(Options["mqtt"]["prefix"], name)
+    options["cache"]["filename"] = bus_filename(Options["cache"]["filename"], name)
+    options["capture"]["filename"] = bus_filename(Options["capture"]["filename"], name)
+    options["gateway"]["port"] = Options["gateway"]["port"] + index
+    return options
+
+
+def init_buses():
+    # 이 파일을 bus마다 별도 module로 한번 더 읽어서, 장치 상태, framer, 명령 대기열 같은 전역 상태를 bus마다 따로 갖게 한다.
+    # MQTT 연결, publish 대기열, 로그는 함께 쓰고, 각 bus는 자기 스레드에서 돈다
+    if Options["loop_mode"] == "asyncio":
+        logger.warning("buses works with blocking loop_mode only! automatically changed...")
+        Options["loop_mode"] = "blocking"
+
+    for index, entry in enumerate(Options["buses"]):
+        name = entry["name"]
+        if not re.fullmatch(r"[A-Za-z0-9_-]+", name) or name in buses:
+            raise AssertionError("bus name '{}' is invalid or duplicated!".format(name))
+
+        logger.info("initialize bus {} ({})...".format(name, entry["serial_mode"]))
+        spec = importlib.util.spec_from_file_location("sds_wallpad_bus_{}".format(name), os.path.abspath(__file__))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+
+        module.Options = bus_options(entry, index)
+        module.mqtt = mqtt
+        module.publish_queue = publish_queue
+        module.logger = logging.getLogger("{}.{}".format(logger.name, name))
+        module.logger.addFilter(SDSLogPrefix(name))
+
+        module.init_virtual_device()
+        module.init_codec()
+        module.init_publish_policy()
+        module.init_cache()
+        module.init_dispatch()
+        module.init_timer()
+        module.init_command_queue()
+        buses[name] = module
+
+
+def bus_on_connect(mqtt, userdata, flags, rc):
+    global mqtt_connected
+    mqtt_connected = rc == 0
+
+    for module in buses.values():
+        module.mqtt_on_connect(mqtt, userdata, flags, rc)
+
+
+def bus_on_disconnect(mqtt, userdata, rc):
+    global mqtt_connected
+    mqtt_connected = False
+
+    for module in buses.values():
+        module.mqtt_on_disconnect(mqtt, userdata, rc)
+
+
+def bus_on_message(mqtt, userdata, msg):
+    # prefix로 어느 bus 것인지 찾아서 넘김, HA 상태는 모든 bus에
+    for module in buses.values():
+        if msg.topic == "homeassistant/status" or msg.topic.startswith(module.Options["mqtt"]["prefix"] + "/"):
+            module.mqtt_on_message(mqtt, userdata, msg)
+
+
+def bus_loop():
+    # 여러 bus 모드: 연결하고 polling 처리, 오래 끊겨도 다른 bus까지 재시작하지 않고 계속 다시 시도
+    start_timer_loop()
+
+    while True:
+        try:
+            conn_init()
+            dump_loop()
+
+            while True:
+                try:
+                    serial_loop()
+                except RuntimeError as e:
+                    conn_reconnect(e)
+
+        except RuntimeError as e:
+            logger.warning("RuntimeError occurred: {} - retry after {} seconds.".format(e, RECONNECT_DELAY_MAX))
+            cache_save()
+            time.sleep(RECONNECT_DELAY_MAX)
+        except Exception as e:
+            logger.exception("bus exception! ({})".format(str(e)))
+            return
+
+
+def bus_run():
+    threads = []
+    for name, module in buses.items():
+        thread = threading.Thread(target=module.bus_loop, name="bus-{}".format(name), daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    # 하나라도 예상 못한 예외로 멈추면 애드온 종료
+    while all(thread.is_alive() for thread in threads):
+        time.sleep(1)
 
 if __name__ == "__main__":
     # configuration 로드 및 로거 설정
     init_logger()
     init_option(sys.argv)
     init_logger_file()
+    init_logger_queue()
+
+    # 애드온 정지(SIGTERM)도 정상 종료로 처리해서 atexit (cache, capture 파일 등)이 실행되도록
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # 여러 RS485 선: bus마다 스레드, MQTT 연결은 하나
+    if Options["buses"]:
+        init_publish_queue()
+        init_buses()
+        start_metrics_server()
+
+        send_discord_message_with_curl(Options["webhook_url"], "Addon started.")
+        start_mqtt_loop()
+        bus_run()
+        sys.exit(1)
 
     init_virtual_device()
+    init_codec()
+    init_publish_policy()
+    init_cache()
+    init_dispatch()
+    init_timer()
+    init_command_queue()
+    init_publish_queue()
+    start_metrics_server()
 
     send_discord_message_with_curl(Options["webhook_url"], "Addon started.")
     
@@ -1412,15 +4082,30 @@ if __name__ == "__main__":
         try:
             conn_init()
             dump_loop()
-            start_mqtt_loop()
-
-            # 무한 루프
-            serial_loop()
+            if Options["loop_mode"] == "asyncio":
+                asyncio.run(async_loop())
+            else:
+                start_timer_loop()
+                start_mqtt_loop()
+
+                # 무한 루프, 연결이 끊기면 다시 연결해서 이어감
+                while True:
+                    try:
+                        serial_loop()
+                    except RuntimeError as e:
+                        if Options["serial_mode"] == "replay":
+                            raise
+                        conn_reconnect(e)
 
         except RuntimeError as e:
+            if Options["serial_mode"] == "replay":
+                logger.info("replay stopped: {}".format(e))
+                break
+
             error_msg = f"RuntimeError occurred: {e} - Restarting addon."
             logger.warning(error_msg)
             send_discord_message_with_curl(Options["webhook_url"], error_msg)
+            cache_save()
             restart_addon()
             # time.sleep(2)
         except Exception as e:
@@ -0,0 +1,626 @@
+# 삼성 SDS 월패드 RS485 bus 시뮬레이터
+# 월패드(master)와 장치들을 흉내내서, RS485 장치 없이 애드온의 처리량, 명령 지연시간, 충돌 동작을 확인하기 위한 용도
+#
+# 사용법:
+#   python3 wallpad_simulator.py --pty              -> 출력되는 /dev/pts/N 을 serial port로 설정
+#   python3 wallpad_simulator.py --tcp 8899         -> socket 모드로 127.0.0.1:8899 에 연결
+#   python3 wallpad_simulator.py --check            -> 애드온이 장치들의 query/응답 짝을 맞춰 등록하는지 확인 (실패하면 exit code 1)
+# 패킷 형식은 DOCS_PACKETS.md 참고
+
+import argparse
+import logging
+import os
+import random
+import select
+import socket
+import time
+
+logger = logging.getLogger(__name__)
+
+# 응답 장치가 없을 때 기다리는 시간, 패킷 사이 간격, 장치가 응답하기까지 걸리는 시간
+RESPONSE_TIMEOUT = 0.03
+PACKET_GAP = 0.01
+RESPONSE_DELAY = 0.004
+
+# 응답 없이 이 횟수만큼 지나면 해당 장치를 다시 스캔 (XX 5A)
+SCAN_AFTER = 5
+
+# 수신 패킷 길이 (header 첫 Byte 기준)
+COMMAND_LENGTH = {
+    0xAB: 4, 0xAC: 5, 0xAD: 4, 0xAE: 8, 0xC2: 6, 0xC6: 10,
+    0xA1: 4, 0xA2: 4, 0xA3: 4, 0xA4: 4, 0xA5: 4, 0xA6: 4,
+}
+
+
+def checksum(packet):
+    # 모든 Byte를 XOR한 후 최상위 bit를 0으로
+    res = 0
+    for b in packet:
+        res ^= b
+    return res & 0x7F
+
+
+def make_packet(*data):
+    packet = bytearray(data)
+    packet.append(checksum(packet))
+    return bytes(packet)
+
+
+def verify(packet):
+    return checksum(packet[:-1]) == packet[-1]
+
+
+class Device:
+    # 월패드가 조회하는 장치 하나, query() 결과로 보낼 조회 패킷 목록과 응답을 정의
+    def __init__(self, header):
+        self.header = header
+        self.scan = True
+
+    def queries(self):
+        return []
+
+    def respond(self, packet):
+        return None
+
+    def command(self, packet):
+        # 명령을 처리하고 ack 패킷을 돌려줌, 모르는 명령이면 None
+        return None
+
+
+class Light(Device):
+    def __init__(self, rooms):
+        super().__init__(0xAC)
+        # (방 번호, 첫 그룹 번호, 조명 상태 bitmap)
+        self.rooms = []
+        group = 1
+        for i, count in enumerate(rooms):
+            self.rooms.append([(count << 4) | (i + 1), group, 0])
+            group += count
+
+    def queries(self):
+        return [make_packet(0xAC, 0x79, 0x00, room[1]) for room in self.rooms]
+
+    def respond(self, packet):
+        for rn, group, bitmap in self.rooms:
+            if group == packet[3]:
+                return make_packet(0xB0, 0x79, rn, bitmap)
+
+    def command(self, packet):
+        if packet[1] != 0x7A:
+            return None
+
+        # 일괄소등
+        if packet[2] == 0:
+            for room in self.rooms:
+                room[2] = 0
+            return make_packet(0xB0, 0x7A, 0x00, 0x00)
+
+        for room in self.rooms:
+            bit = packet[2] - room[1]
+            if 0 <= bit < room[0] >> 4:
+                if packet[3]:
+                    room[2] |= 1 << bit
+                else:
+                    room[2] &= ~(1 << bit)
+                return make_packet(0xB0, 0x7A, packet[2], packet[3])
+
+
+class Thermostat(Device):
+    def __init__(self, count, rnd):
+        super().__init__(0xAE)
+        self.rnd = rnd
+        # 그룹 번호: [켜짐, 설정온도, 현재온도]
+        self.rooms = {i: [0, 22, 20] for i in range(1, count + 1)}
+
+    def queries(self):
+        return [make_packet(0xAE, 0x7C, i, 0, 0, 0, 0) for i in self.rooms]
+
+    def _state(self, cmd, i, value=None):
+        power, target, current = self.rooms[i]
+        return make_packet(0xB0, cmd, i, power, target if value is None else value, current, 0xFF)
+
+    def respond(self, packet):
+        room = self.rooms.get(packet[2])
+        if not room:
+            return None
+
+        # 현재온도는 켜져 있으면 설정온도 쪽으로, 꺼져 있으면 18도까지 천천히 내려감
+        if self.rnd.random() < 0.05:
+            goal = room[1] if room[0] else min(room[2], 18)
+            room[2] += (goal > room[2]) - (goal < room[2])
+        return self._state(0x7C, packet[2])
+
+    def command(self, packet):
+        room = self.rooms.get(packet[2])
+        if not room:
+            return None
+
+        if packet[1] == 0x7D:
+            room[0] = packet[3] & 1
+            return self._state(0x7D, packet[2])
+        if packet[1] == 0x7F:
+            room[1] = packet[3]
+            return self._state(0x7F, packet[2], packet[3])
+
+
+class Plug(Device):
+    def __init__(self, count, rnd):
+        super().__init__(0xC6)
+        self.rnd = rnd
+        # 그룹 번호: [켜짐, 대기전력 차단]
+        self.plugs = {i: [1, 1] for i in range(1, count + 1)}
+
+    def queries(self):
+        return [make_packet(0xC6, 0x4A, i, 0, 0, 0, 0, 0, 0) for i in self.plugs]
+
+    def respond(self, packet):
+        plug = self.plugs.get(packet[2])
+        if not plug:
+            return None
+
+        state = plug[0] | (plug[1] << 4)
+        watt = self.rnd.randint(0, 120) if plug[0] else 0
+        return make_packet(0xB0, 0x4A, packet[2], state, watt >> 8, watt & 0xFF, 0, 0, 0)
+
+    def command(self, packet):
+        plug = self.plugs.get(packet[2])
+        if not plug or packet[1] not in (0x6E, 0x4B):
+            return None
+
+        if packet[1] == 0x6E:
+            plug[0] = packet[3] & 1
+        else:
+            plug[1] = packet[3] & 1
+            # 꺼진 상태에서 차단 기능을 끄면 바로 켜짐
+            if not plug[1]:
+                plug[0] = 1
+        return make_packet(0xB0, packet[1], packet[2], packet[3], 0, 0, 0, 0, 0)
+
+
+class Fan(Device):
+    def __init__(self):
+        super().__init__(0xC2)
+        # 속도 (1: 3단 ~ 3: 1단, 4: 자동), 켜짐
+        self.speed = 3
+        self.power = 0
+
+    def queries(self):
+        return [make_packet(0xC2, 0x4E, 0, 0, 0)]
+
+    def respond(self, packet):
+        return make_packet(0xB0, 0x4E, self.speed, int(self.speed == 4), 0 if self.power else 1)
+
+    def command(self, packet):
+        if packet[1] != 0x4F:
+            return None
+
+        value = packet[2]
+        if value == 6:
+            self.power = 0
+        elif value == 5:
+            self.power = 1
+        elif 1 <= value <= 4:
+            self.speed = value
+            self.power = 1
+        return make_packet(0xB0, 0x4F, value, 0, 0)
+
+
+class Energy(Device):
+    def __init__(self, count, rnd):
+        super().__init__(0xAA)
+        self.rnd = rnd
+        self.count = count
+
+    def queries(self):
+        return [make_packet(0xAA, 0x6F, i) for i in range(self.count)]
+
+    def respond(self, packet):
+        # 10진수 6자리
+        value = "{:06d}".format(self.rnd.randint(0, 5000 if packet[2] == 0 else 200))
+        return make_packet(0xB0, 0x6F, packet[2], *bytes.fromhex(value))
+
+
+class GasValve(Device):
+    def __init__(self):
+        super().__init__(0xAB)
+        self.closed = 0
+
+    def queries(self):
+        return [make_packet(0xAB, 0x41, 0)]
+
+    def respond(self, packet):
+        return make_packet(0xB0, 0x41, self.closed)
+
+    def command(self, packet):
+        if packet[1] != 0x78:
+            return None
+        self.closed = 1
+        return make_packet(0xB0, 0x78, 0x00)
+
+
+class Entrance(Device):
+    # 현관 스위치, 일괄소등 상태만 관리
+    def __init__(self, gas):
+        super().__init__(0xAD)
+        self.gas = gas
+        self.cutoff = 1
+
+    def queries(self):
+        return [make_packet(0xAD, 0x41, 0), make_packet(0xAD, 0x52, 0)]
+
+    def respond(self, packet):
+        if packet[1] == 0x52:
+            return make_packet(0xB0, 0x52, self.cutoff)
+        return make_packet(0xB0, 0x41, 0)
+
+    def command(self, packet):
+        if packet[1] != 0x53:
+            return None
+        self.cutoff = packet[2] & 1
+        return make_packet(0xB0, 0x53, self.cutoff)
+
+
+class Virtual(Device):
+    # 애드온이 대신 응답할 장치 (현관 스위치, 인터폰), 시뮬레이터는 월패드 역할만 함
+    def __init__(self, header, gas=None):
+        super().__init__(header)
+        self.gas = gas
+        self.event = None
+
+    def queries(self):
+        # 장치가 알린 이벤트가 있으면 월패드 ACK 먼저
+        if self.event:
+            event, self.event = self.event, None
+            return [event]
+
+        if self.header == 0xAD:
+            return [make_packet(0xAD, 0x41, 0), make_packet(0xAD, 0x52, 0)]
+        return [make_packet(self.header, 0x41, 0)]
+
+    def accept(self, query, resp):
+        # 장치 응답이 이벤트면 다음 차례에 보낼 월패드 ACK를 만듦
+        if resp[1] in (0x41, 0x42, 0x52, 0x5A) or resp[1] == query[1]:
+            return
+
+        if resp[1] == 0x2F:
+            value = 0
+        elif resp[1] == 0x56:
+            value = self.gas.closed if self.gas else 0
+        else:
+            value = resp[2]
+        self.event = make_packet(self.header, resp[1], value)
+
+
+class Bus:
+    def __init__(self, args):
+        self.rnd = random.Random(args.seed)
+        self.byte_time = 11 / args.baudrate
+        self.link_delay = args.link_delay / 1000
+        self.byte_error = 1 - (1 - args.ber) ** 8
+
+        self.stats = dict.fromkeys(("cycles", "frames", "commands", "acks", "collisions", "rx_errors", "virtual"), 0)
+
+        # 실제 월패드와 비슷한 조회 순서
+        gas = GasValve()
+        self.devices = []
+        if args.virtual:
+            self.devices += [Virtual(0xA0 + i) for i in range(1, 7)]
+        else:
+            self.devices += [Device(0xA0 + i) for i in range(1, 7)]
+        self.devices.append(gas)
+        if args.lights:
+            self.devices.append(Light([int(x) for x in args.lights.split(",")]))
+        if args.thermostats:
+            self.devices.append(Thermostat(args.thermostats, self.rnd))
+        if args.plugs:
+            self.devices.append(Plug(args.plugs, self.rnd))
+        if args.fan:
+            self.devices.append(Fan())
+        if args.energy:
+            self.devices.append(Energy(args.energy, self.rnd))
+        self.devices.append(Virtual(0xAD, gas) if args.virtual else Entrance(gas))
+
+        self.by_header = {device.header: device for device in self.devices}
+        self.misses = {device.header: 0 for device in self.devices}
+
+        self._rx = bytearray()
+        self._fd = None
+        self._write = None
+        self._read = None
+
+    def attach(self, fd, read, write):
+        self._fd = fd
+        self._read = read
+        self._write = write
+        self._rx.clear()
+
+    def _poll(self, timeout):
+        # timeout 동안 들어온 데이터를 모음, 연결이 끊어지면 EOFError
+        readable, _, _ = select.select([self._fd], [], [], max(timeout, 0))
+        if not readable:
+            return False
+
+        data = self._read()
+        if not data:
+            raise EOFError
+        self._rx += data
+        return True
+
+    def transmit(self, packet):
+        # 1 Byte씩 전송 시간에 맞춰 보냄, 그 사이에 상대가 보내기 시작하면 충돌로 둘 다 깨짐
+        # 상대가 보낸 데이터는 link_delay 뒤에 bus에 실린 것으로 봄 (USB 변환기, EW11 지연)
+        collision = False
+        out = bytearray(packet)
+        end = time.monotonic() + self.byte_time * len(out)
+        for i in range(len(out)):
+            deadline = time.monotonic() + self.byte_time
+            if self._poll(0) and time.monotonic() + self.link_delay < end:
+                collision = True
+            if collision or self.rnd.random() < self.byte_error:
+                out[i] ^= 1 << self.rnd.randrange(8)
+            self._write(out[i:i+1])
+
+            remain = deadline - time.monotonic()
+            if remain > 0:
+                time.sleep(remain)
+
+        self.stats["frames"] += 1
+        if collision:
+            self.stats["collisions"] += 1
+            self._rx.clear()
+        return not collision
+
+    def idle(self, duration):
+        # bus가 조용한 동안 들어온 명령 처리
+        deadline = time.monotonic() + duration
+        while True:
+            remain = deadline - time.monotonic()
+            if not self._poll(remain if remain > 0 else 0):
+                if remain <= 0:
+                    return
+
+                continue
+
+            # 패킷이 다 들어올 때까지 조금 더 기다림
+            while self._poll(self.byte_time * 2):
+                pass
+            self._handle_rx()
+
+    def _take_frame(self):
+        # 수신 버퍼에서 패킷 하나를 꺼냄, 깨진 데이터는 버림
+        rx = self._rx
+        while rx:
+            length = 4 if rx[0] == 0xB0 else COMMAND_LENGTH.get(rx[0])
+            if not length:
+                del rx[0]
+                self.stats["rx_errors"] += 1
+                continue
+            if len(rx) < length:
+                return None
+
+            packet = bytes(rx[:length])
+            if not verify(packet):
+                del rx[0]
+                self.stats["rx_errors"] += 1
+                continue
+
+            del rx[:length]
+            return packet
+        return None
+
+    def _handle_rx(self):
+        while True:
+            packet = self._take_frame()
+            if not packet:
+                return
+
+            device = self.by_header.get(packet[0])
+            if not device:
+                continue
+
+            self.stats["commands"] += 1
+            ack = device.command(packet)
+            if ack:
+                time.sleep(RESPONSE_DELAY)
+                if self.transmit(ack):
+                    self.stats["acks"] += 1
+                logger.debug("command {} -> ack {}".format(packet.hex(), ack.hex()))
+
+    def _wait_response(self):
+        # 조회 후 장치 응답을 기다림 (애드온이 응답할 가상 장치)
+        # 조회 패킷을 보내는 중에 이미 응답이 도착했을 수도 있음
+        deadline = time.monotonic() + RESPONSE_TIMEOUT
+        while True:
+            while self._poll(self.byte_time * 2):
+                pass
+            packet = self._take_frame()
+            if packet and packet[0] == 0xB0:
+                return packet
+
+            if time.monotonic() >= deadline or not self._poll(deadline - time.monotonic()):
+                return None
+
+    def query(self, device, packet):
+        header = device.header
+        if device.scan:
+            packet = make_packet(header, 0x5A, 0)
+
+        if not self.transmit(packet):
+            return
+
+        if isinstance(device, Virtual):
+            resp = self._wait_response()
+            if resp:
+                self.stats["virtual"] += 1
+                if not device.scan:
+                    device.accept(packet, resp)
+        elif type(device) is Device:
+            # 없는 장치 (인터폰): 응답 없음
+            time.sleep(RESPONSE_TIMEOUT)
+            resp = None
+        else:
+            time.sleep(RESPONSE_DELAY)
+            resp = make_packet(0xB0, 0x5A, 0) if device.scan else device.respond(packet)
+            if resp and not self.transmit(resp):
+                resp = None
+
+        # 스캔에 응답하면 정상 조회 시작, 계속 응답이 없으면 다시 스캔
+        if resp:
+            self.misses[header] = 0
+            if device.scan and resp[1] == 0x5A:
+                device.scan = False
+        else:
+            self.misses[header] += 1
+            if self.misses[header] >= SCAN_AFTER:
+                device.scan = True
+
+    def cycle(self):
+        for device in self.devices:
+            for packet in (device.queries() if not device.scan else [None]):
+                self.query(device, packet)
+                self.idle(PACKET_GAP)
+        self.stats["cycles"] += 1
+
+
+def serve_pty(bus, args):
+    import tty
+
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    logger.info("simulator pty: {}".format(os.ttyname(slave)))
+
+    bus.attach(master, lambda: os.read(master, 1024), lambda data: os.write(master, data))
+    run(bus, args)
+
+
+def serve_tcp(bus, args):
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(("", args.tcp))
+    server.listen(1)
+    logger.info("simulator listening on port {}".format(args.tcp))
+
+    while True:
+        client, addr = server.accept()
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        logger.info("client connected: {}".format(addr))
+
+        bus.attach(client.fileno(), lambda: client.recv(1024), client.sendall)
+        try:
+            run(bus, args)
+        except (EOFError, OSError) as e:
+            logger.info("client disconnected ({})".format(e))
+        client.close()
+
+
+def check_addon(bus):
+    # 애드온의 query/응답 짝 맞추기와 장치 등록을 시뮬레이터 장치의 패킷으로 확인 (RS485 연결 없이)
+    # 장치마다 discovery_confirm 번 query -> 응답을 넣어서 등록되는지, 무응답이 응답한 id로 세어지는지 본다
+    import json
+    import sds_wallpad as addon
+
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.json")) as f:
+        addon.Options = json.load(f)["options"]
+    addon.serial_loop_init()
+
+    failed = 0
+    confirm = addon.Options["mqtt"]["discovery_confirm"]
+    for device in bus.devices:
+        if type(device) is Device or isinstance(device, Virtual):
+            continue
+
+        for query in device.queries():
+            info = addon.QUERY_HEADER.get((query[0] << 8) | query[1])
+            if not info or info[0] not in addon.TRANSACTION_DEVICE:
+                continue
+
+            name = info[0]
+            resp = device.respond(query)
+            pos = addon.RS485_DEVICE[name]["state"].get("id")
+            idn = resp[pos] if pos is not None else 1
+
+            ok = False
+            for i in range(confirm):
+                now = time.monotonic()
+                addon.transaction_begin(name, query, now)
+                paired = addon.transaction_end(name, resp, now)
+                ok = paired == query and addon.serial_confirm_device(name, idn, resp, paired)
+
+            # 응답이 없으면 응답했던 id의 무응답으로 세어야 함
+            addon.transaction_begin(name, query, time.monotonic())
+            addon.transaction_begin(name, None, time.monotonic())
+            stat = addon.transaction_stat.get((name, idn))
+            ok = ok and stat is not None and stat[:2] == [confirm, 1]
+
+            logger.info("check {} {:x}: {} -> {} {}".format(name, idn, query.hex(), resp.hex(), "ok" if ok else "FAIL"))
+            failed += not ok
+
+    # 월패드가 없는 id를 계속 조회해도 (응답 없음) 통계에 생기면 안됨
+    for name, prop in addon.RS485_DEVICE.items():
+        query = prop.get("query")
+        if not query or "id" not in query or name not in addon.TRANSACTION_DEVICE:
+            continue
+
+        packet = bytearray(query["length"])
+        packet[0:2] = query["header"].to_bytes(2, "big")
+        packet[query["id"]] = 0x7E
+        packet[-1] = checksum(packet[:-1])
+        for i in range(addon.Options["rs485"]["offline_miss"] + 1):
+            addon.transaction_begin(name, bytes(packet), time.monotonic())
+    addon.transaction_begin(name, None, time.monotonic())
+
+    # 한번도 응답하지 않은 (없는) 장치가 통계에 생기면 안됨
+    phantom = sorted(key for key, stat in addon.transaction_stat.items() if not stat[0])
+    if phantom:
+        logger.warning("check: phantom devices in reply statistics: {}".format(phantom))
+        failed += len(phantom)
+
+    return failed
+
+
+def run(bus, args):
+    report = time.monotonic()
+    while True:
+        bus.cycle()
+
+        if args.stats and time.monotonic() - report > args.stats:
+            report = time.monotonic()
+            logger.info(" ".join("{}={}".format(k, v) for k, v in bus.stats.items()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Samsung SDS wallpad RS485 bus simulator")
+    transport = parser.add_mutually_exclusive_group(required=True)
+    transport.add_argument("--pty", action="store_true", help="serve on a pseudo terminal (serial_mode: serial)")
+    transport.add_argument("--tcp", type=int, metavar="PORT", help="serve on a TCP port (serial_mode: socket)")
+    transport.add_argument("--check", action="store_true", help="check the addon's query/reply pairing against the simulated devices and exit")
+
+    parser.add_argument("--lights", default="4,1,1", help="light count per room, comma separated (default: 4,1,1)")
+    parser.add_argument("--thermostats", type=int, default=4)
+    parser.add_argument("--plugs", type=int, default=4)
+    parser.add_argument("--fan", type=int, default=1, choices=(0, 1))
+    parser.add_argument("--energy", type=int, default=3, choices=(0, 1, 2, 3))
+    parser.add_argument("--virtual", action="store_true", help="leave entrance switch and intercoms to the addon (entrance_mode/intercom_mode)")
+
+    parser.add_argument("--ber", type=float, default=0.0, help="bit error rate of transmitted bytes")
+    parser.add_argument("--baudrate", type=int, default=9600)
+    parser.add_argument("--link-delay", type=float, default=3.0, help="delay in ms before addon data reaches the bus (default: 3)")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--stats", type=float, default=10.0, help="statistics report interval in seconds (0: off)")
+    parser.add_argument("--debug", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
+                        format="%(asctime)s %(levelname)-8s %(message)s", datefmt="%H:%M:%S")
+
+    bus = Bus(args)
+    if args.check:
+        parser.exit(1 if check_addon(bus) else 0)
+
+    try:
+        if args.pty:
+            serve_pty(bus, args)
+        else:
+            serve_tcp(bus, args)
+    except KeyboardInterrupt:
+        logger.info(" ".join("{}={}".format(k, v) for k, v in bus.stats.items()))
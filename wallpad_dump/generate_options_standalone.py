@@ -14,6 +14,7 @@ if __name__ == "__main__":
 
     # 로그 파일 경로 변경
     Options["log"]["filename"] = "./log/wallpad_dump.log"
+    Options["capture"]["filename"] = "./capture/dump.cap"
 
     # 파일 생성
     with open(option_file, "w") as f:
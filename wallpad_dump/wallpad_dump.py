@@ -8,10 +8,27 @@ import sys
 import logging
 from logging.handlers import RotatingFileHandler
 import os.path
-from time import sleep
+import time
+import struct
+import queue
+import shutil
+import gzip
+import threading
+import signal
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 ####################
 
+# capture 파일 형식 (sds_wallpad의 capture와 같음, sds_wallpad의 serial_mode: replay로 재생 가능)
+# header (magic, 시작 시각) 후 record (이전 record와의 간격 us, 방향|길이) + data 반복
+CAPTURE_MAGIC = b"SDSCAP\x01\x00"
+CAPTURE_HEADER = struct.Struct("<8sd")
+CAPTURE_RECORD = struct.Struct("<IH")
+
 logger = logging.getLogger(__name__)
 
 
@@ -44,6 +61,11 @@ class SDSSerial:
         self._pending_recv = max(self._pending_recv - count, 0)
         return self._recv_raw(count)
 
+    def recv_into(self, view):
+        # 이미 도착해 있는 만큼 한번에 읽음, 없으면 1 Byte 올 때까지 대기 (timeout 없음)
+        size = min(max(self._ser.in_waiting, 1), len(view))
+        return self._ser.readinto(view[:size])
+
     def send(self, a):
         self._ser.write(a)
 
@@ -95,6 +117,19 @@ class SDSSocket:
         del self._recv_buf[0:count]
         return res
 
+    def recv_into(self, view):
+        # 버퍼에 남은 것부터, 없으면 도착할 때까지 대기 (timeout 없음)
+        if self._recv_buf:
+            n = min(len(self._recv_buf), len(view))
+            view[:n] = self._recv_buf[:n]
+            del self._recv_buf[:n]
+            return n
+
+        n = self._soc.recv_into(view)
+        if not n:
+            raise RuntimeError("socket connection lost!")
+        return n
+
     def send(self, a):
         self._soc.sendall(a)
 
@@ -114,6 +149,104 @@ class SDSSocket:
         self._soc.settimeout(a)
 
 
+class SDSCapture:
+    # 받은 데이터를 수신 시각과 함께 그대로 segment 파일에 기록, 크기가 넘으면 다음 파일로 넘어감
+    # 다 쓴 segment 압축은 별도 스레드에서 하므로 수신이 밀리지 않음
+    def __init__(self, filename, segment_size, compress):
+        root, ext = os.path.splitext(filename)
+        self._pattern = "{}.{}-{{:04d}}{}".format(root, time.strftime("%Y%m%d-%H%M%S"), ext or ".cap")
+        self._limit = segment_size * 1024 * 1024
+        self._seq = 0
+        self._file = None
+
+        if compress == "zstd" and not zstandard:
+            logger.warning("zstandard module not found! automatically changed to gzip...")
+            compress = "gzip"
+        self._compress = compress
+
+        self._thread = None
+        if compress != "none":
+            self._queue = queue.SimpleQueue()
+            self._thread = threading.Thread(target=self._compress_loop, daemon=True)
+            self._thread.start()
+
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self._open()
+
+    def _open(self):
+        self._seq += 1
+        self._name = self._pattern.format(self._seq)
+        logger.info("capture to {}".format(self._name))
+
+        self._file = open(self._name, "wb")
+        self._file.write(CAPTURE_HEADER.pack(CAPTURE_MAGIC, time.time()))
+        self._size = CAPTURE_HEADER.size
+        self._last = time.monotonic()
+        self._flush_time = self._last
+
+    def _close(self):
+        self._file.close()
+        if self._compress != "none":
+            self._queue.put(self._name)
+
+    def write(self, data):
+        now = time.monotonic()
+        interval = min(int((now - self._last) * 1000000), 0xFFFFFFFF)
+        self._last = now
+
+        self._file.write(CAPTURE_RECORD.pack(interval, len(data)))
+        self._file.write(data)
+        self._size += CAPTURE_RECORD.size + len(data)
+
+        if self._size >= self._limit:
+            self._close()
+            self._open()
+        elif now - self._flush_time > 1:
+            self._file.flush()
+            self._flush_time = now
+
+    def close(self):
+        self._close()
+
+        # 마지막 segment까지 압축이 끝나야 종료 (daemon 스레드라 기다리지 않으면 중간에 끊김)
+        if self._thread:
+            logger.info("waiting for compression ...")
+            self._queue.put(None)
+            self._thread.join()
+
+    def _compress_loop(self):
+        ext = ".zst" if self._compress == "zstd" else ".gz"
+        while True:
+            name = self._queue.get()
+            if name is None:
+                return
+
+            target = name + ext
+            try:
+                self._compress_segment(name, target)
+            except Exception as e:
+                # 디스크 부족 등: 원본 segment는 그대로 두고, 만들다 만 파일만 지운 다음 계속
+                logger.error("compress {} failed! ({})".format(name, e))
+                try:
+                    os.remove(target + ".tmp")
+                except OSError:
+                    pass
+
+    def _compress_segment(self, name, target):
+        # 다 쓴 다음에 이름을 바꿔서, 압축 중인 파일이 보이지 않도록
+        if self._compress == "zstd":
+            with open(name, "rb") as src, open(target + ".tmp", "wb") as dst:
+                zstandard.ZstdCompressor().copy_stream(src, dst)
+        else:
+            with open(name, "rb") as src, gzip.open(target + ".tmp", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+
+        size = os.path.getsize(name)
+        os.replace(target + ".tmp", target)
+        os.remove(name)
+        logger.info("compressed {} ({} -> {} bytes)".format(target, size, os.path.getsize(target)))
+
+
 def init_logger():
     logger.setLevel(logging.INFO)
 
@@ -172,13 +305,13 @@ def init_option(argv):
 
 
 def dump_loop():
-    conn.set_timeout(0.0)
+    # 도착할 때까지 기다렸다가 (polling 하지 않음), 도착한 만큼 한 줄로 남김
+    buf = bytearray(4096)
+    view = memoryview(buf)
     logs = []
     while True:
-        try:
-            data = conn.recv(conn.check_in_waiting())
-        except:
-            continue
+        n = conn.recv_into(view)
+        data = buf[:n]
 
         if data:
             logs = []
@@ -192,13 +325,29 @@ def dump_loop():
 #               else:           logs.append(",  {:02X}".format(b))
                 logs.append(" {:02X}".format(b))
             logger.info("".join(logs))
-        sleep(0.01)
 
     logger.info("".join(logs))
     logger.warning("dump done.")
     conn.set_timeout(None)
 
 
+def capture_loop():
+    # 받은 그대로 시각과 함께 기록만 함, 텍스트로는 wallpad_render.py 로 필요할 때 변환
+    capture = SDSCapture(Options["capture"]["filename"], Options["capture"]["segment_size"], Options["capture"]["compress"])
+
+    # 애드온을 멈출 때도 마지막 segment를 닫고 끝나도록
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    buf = bytearray(4096)
+    view = memoryview(buf)
+    try:
+        while True:
+            n = conn.recv_into(view)
+            if n:
+                capture.write(view[:n])
+    finally:
+        capture.close()
+
+
 if __name__ == "__main__":
     global conn
 
@@ -214,4 +363,7 @@ if __name__ == "__main__":
         logger.info("initialize serial...")
         conn = SDSSerial()
 
-    dump_loop()
+    if Options["capture"]["enable"]:
+        capture_loop()
+    else:
+        dump_loop()
@@ -0,0 +1,179 @@
+# capture segment 파일을 wallpad_dump 로그와 같은 텍스트 형식으로 변환
+#   python3 wallpad_render.py /share/wallpad_dump/dump.*.cap*
+#   --frames: 읽은 단위 대신 패킷(header) 단위로 한 줄씩, --precise: 시각을 us 단위까지
+
+import argparse
+import bisect
+import datetime
+import gzip
+import re
+import struct
+import sys
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+####################
+
+# wallpad_dump.py, sds_wallpad.py 의 capture 형식과 같음
+CAPTURE_MAGIC = b"SDSCAP\x01\x00"
+CAPTURE_HEADER = struct.Struct("<8sd")
+CAPTURE_RECORD = struct.Struct("<IH")
+CAPTURE_TX = 0x8000
+
+# 첫 Byte만 0x80보다 큰 두 Byte, 연속으로 0x80보다 큰 byte가 나오면 마지막 byte가 header
+HEADER_PATTERN = re.compile(rb"[\x80-\xff][\x00-\x7f]")
+
+
+def read_segment(filename):
+    if filename.endswith(".zst"):
+        if not zstandard:
+            raise RuntimeError("zstandard module is required for {}".format(filename))
+        with open(filename, "rb") as f:
+            return zstandard.ZstdDecompressor().stream_reader(f).read()
+    elif filename.endswith(".gz"):
+        with gzip.open(filename, "rb") as f:
+            return f.read()
+    else:
+        with open(filename, "rb") as f:
+            return f.read()
+
+
+def parse_segment(data):
+    # (시각, 보낸 데이터인지, data) 를 차례로 돌려줌, 마지막 record가 덜 써졌으면 거기까지만
+    magic, start = CAPTURE_HEADER.unpack_from(data)
+    if magic != CAPTURE_MAGIC:
+        raise RuntimeError("not a capture file")
+
+    view = memoryview(data)
+    pos = CAPTURE_HEADER.size
+    now = start
+    while pos + CAPTURE_RECORD.size <= len(data):
+        interval, flags = CAPTURE_RECORD.unpack_from(data, pos)
+        pos += CAPTURE_RECORD.size
+        size = flags & ~CAPTURE_TX
+        if pos + size > len(data):
+            break
+
+        now += interval / 1000000
+        yield now, flags & CAPTURE_TX, view[pos:pos + size]
+        pos += size
+
+
+class Clock:
+    # 같은 초의 시각 문자열은 다시 만들지 않음
+    def __init__(self, precise):
+        self._precise = precise
+        self._second = None
+        self._text = None
+
+    def format(self, t):
+        if self._precise:
+            return datetime.datetime.fromtimestamp(t).strftime("%Y-%m-%d %H:%M:%S.%f")
+
+        second = int(t)
+        if second != self._second:
+            self._second = second
+            self._text = datetime.datetime.fromtimestamp(second).strftime("%Y-%m-%d %H:%M:%S")
+        return self._text
+
+
+def render_records(records, clock, out):
+    # 읽은 단위 그대로 한 줄씩 (wallpad_dump 텍스트 모드와 같은 형식)
+    lines = []
+    for t, tx, data in records:
+        lines.append("{} {:<8}  {}".format(clock.format(t), "SEND" if tx else "INFO", data.hex(" ").upper()))
+        if len(lines) >= 4096:
+            out.write("\n".join(lines) + "\n")
+            lines = []
+    if lines:
+        out.write("\n".join(lines) + "\n")
+
+
+def render_frames(records, clock, out):
+    # 받은 데이터를 이어붙인 뒤 header 위치마다 끊어서, 각 패킷의 첫 byte가 도착한 시각으로 한 줄씩
+    # (보낸 데이터는 받은 데이터와 섞이지 않게 따로 한 줄)
+    stream = bytearray()
+    offsets = []
+    times = []
+    lines = []
+
+    def flush(final):
+        starts = [m.start() for m in HEADER_PATTERN.finditer(stream)]
+        if not starts or starts[0] != 0:
+            starts.insert(0, 0)
+
+        # 마지막 패킷은 뒤에 더 올 수 있으므로 남겨둠
+        end = len(stream) if final else starts.pop()
+        bounds = starts + [end]
+        for a, b in zip(bounds, bounds[1:]):
+            if a < b:
+                t = times[bisect.bisect_right(offsets, a) - 1]
+                lines.append("{} {:<8}  {}".format(clock.format(t), "INFO", stream[a:b].hex(" ").upper()))
+
+        out.write("\n".join(lines) + "\n" if lines else "")
+        lines.clear()
+
+        if final:
+            offsets.clear()
+            times.clear()
+            stream.clear()
+            return
+
+        # 남긴 부분의 시각 정보만 유지
+        i = bisect.bisect_right(offsets, end) - 1
+        del offsets[:i]
+        del times[:i]
+        offsets[:] = [max(o - end, 0) for o in offsets]
+        del stream[:end]
+
+    for t, tx, data in records:
+        if tx:
+            # 보내기 전까지 받은 것을 먼저 내보내서 순서를 맞춤
+            if stream:
+                flush(True)
+            lines.append("{} {:<8}  {}".format(clock.format(t), "SEND", data.hex(" ").upper()))
+            continue
+
+        offsets.append(len(stream))
+        times.append(t)
+        stream += data
+        if len(stream) >= 65536:
+            flush(False)
+
+    if stream or lines:
+        flush(True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="render wallpad capture segments as text")
+    parser.add_argument("files", nargs="+", help="capture segments (.cap, .cap.gz, .cap.zst), in order")
+    parser.add_argument("--frames", action="store_true", help="one line per packet instead of per read")
+    parser.add_argument("--precise", action="store_true", help="print time with microseconds")
+    args = parser.parse_args()
+
+    clock = Clock(args.precise)
+    out = sys.stdout
+    failed = False
+    for filename in args.files:
+        try:
+            records = parse_segment(read_segment(filename))
+            if args.frames:
+                render_frames(records, clock, out)
+            else:
+                render_records(records, clock, out)
+        except BrokenPipeError:
+            # head 등으로 출력을 끊은 경우
+            sys.stderr.close()
+            return 0
+        except (RuntimeError, OSError, EOFError, struct.error) as e:
+            print("{}: {}".format(filename, e), file=sys.stderr)
+            failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())